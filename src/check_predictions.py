@@ -0,0 +1,89 @@
+from model import *
+from helper import *
+import os
+import csv
+import json
+import time
+import multiprocessing
+
+# model-free relKKT of predicted solutions
+#       reads ../predictions/primal_{fnm}.sol and dual_{fnm}.sol and the sample {fnm}
+
+import argparse
+parser = argparse.ArgumentParser(description='Check relKKT of prediction files.')
+parser.add_argument('--pred','-p', type=str, default='../predictions')
+parser.add_argument('--samples','-s', type=str, default='../pkl/test')
+parser.add_argument('--out','-o', type=str, default='../logs/kkt_check.csv')
+parser.add_argument('--nworker','-n', type=int, default=1)
+parser.add_argument('--mode','-m', type=str, default='linf')
+parser.add_argument('--norm', type=int, default=0)
+parser.add_argument('--eta_opt', type=float, default=1e+6)
+args = parser.parse_args()
+
+FIELDS = ['instance','n','m','relkkt','primal','dual','gap','time','error']
+
+modf = None
+device = torch.device('cpu')
+
+def init_worker(threads,mode,eta_opt,norm):
+    global modf
+    set_threads(threads)
+    modf = relKKT_general(mode,eta_opt,norm)
+
+def check_one(fnm):
+    row = {'instance':fnm}
+    st = time.time()
+    try:
+        x = read_sol(f'{args.pred}/primal_{fnm}.sol',device)
+        y = read_sol(f'{args.pred}/dual_{fnm}.sol',device)
+        inst = load_kkt_instance(f'{args.samples}/{fnm}',device)
+        if x.shape[0] != inst['A'].shape[1] or y.shape[0] != inst['A'].shape[0]:
+            raise ValueError(f'size mismatch: x {x.shape[0]} / n {inst["A"].shape[1]}, y {y.shape[0]} / m {inst["A"].shape[0]}')
+        with torch.no_grad():
+            res,t1,t2,t3 = kkt_eval(inst,modf,x,y)
+        row['n'] = inst['A'].shape[1]
+        row['m'] = inst['A'].shape[0]
+        row['relkkt'] = res.item()
+        row['primal'] = t1.item()
+        row['dual'] = t2.item()
+        row['gap'] = t3.item()
+    except Exception as e:
+        row['error'] = str(e)
+    row['time'] = time.time()-st
+    return row
+
+
+if __name__ == '__main__':
+    pairs = []
+    for f in sorted(os.listdir(args.pred)):
+        if f.startswith('primal_') and f.endswith('.sol'):
+            fnm = f[len('primal_'):-len('.sol')]
+            if os.path.exists(f'{args.pred}/dual_{fnm}.sol'):
+                pairs.append(fnm)
+    print(f'{len(pairs)} prediction pairs in {args.pred}')
+
+    nworker = max(1,args.nworker)
+    worker_threads = max(1,os.cpu_count()//nworker)
+    rows = []
+    with multiprocessing.Pool(nworker,initializer=init_worker,initargs=(worker_threads,args.mode,args.eta_opt,args.norm==1)) as pool:
+        for row in pool.imap(check_one,pairs):
+            rows.append(row)
+            if 'error' in row:
+                print(f'{row["instance"]}: {row["error"]}')
+            else:
+                print(f'{row["instance"]}: relKKT {row["relkkt"]}   primal {row["primal"]}   dual {row["dual"]}   gap {row["gap"]}')
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)),exist_ok=True)
+    f = open(args.out,'w')
+    if args.out.endswith('.jsonl'):
+        for row in rows:
+            f.write(json.dumps(row)+'\n')
+    else:
+        w = csv.DictWriter(f,fieldnames=FIELDS)
+        w.writeheader()
+        for row in rows:
+            w.writerow(row)
+    f.close()
+    ok = [r['relkkt'] for r in rows if 'error' not in r]
+    if len(ok) > 0:
+        print(f'checked {len(ok)}/{len(rows)}, mean relKKT {sum(ok)/len(ok)}, written to {args.out}')
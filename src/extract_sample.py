@@ -226,6 +226,7 @@ with alive_bar(len(train_files),title=f"Generating Training samples") as bar:
             to_pack['A_ori'] = A_ori.float()
             to_pack['c_ori'] = torch.as_tensor(c_ori).float()
             to_pack['b_ori'] = torch.as_tensor(b_ori).float()
+            to_pack['Q_kind'], to_pack['Q_bw'] = q_structure(Q)
 
             to_pack['x'] = x
             to_pack['y'] = y
@@ -275,6 +276,7 @@ with alive_bar(len(valid_files),title=f"Generating Validating samples") as bar:
             to_pack['A_ori'] = A_ori.float()
             to_pack['c_ori'] = torch.as_tensor(c_ori).float()
             to_pack['b_ori'] = torch.as_tensor(b_ori).float()
+            to_pack['Q_kind'], to_pack['Q_bw'] = q_structure(Q)
 
             to_pack['x'] = x
             to_pack['y'] = y
@@ -324,6 +326,7 @@ with alive_bar(len(test_files),title=f"Generating Testing samples") as bar:
             to_pack['A_ori'] = A_ori.float()
             to_pack['c_ori'] = torch.as_tensor(c_ori).float()
             to_pack['b_ori'] = torch.as_tensor(b_ori).float()
+            to_pack['Q_kind'], to_pack['Q_bw'] = q_structure(Q)
 
             to_pack['x'] = x
             to_pack['y'] = y
@@ -204,7 +204,9 @@ if not ('1' in cont or 'Y' in cont or 'y' in cont):
 #         bar()
 
 nworker=args.nworker
-pool = multiprocessing.Pool(nworker)
+# one intra-op thread share per worker so the pool does not oversubscribe the cores
+worker_threads = max(1,os.cpu_count()//nworker)
+pool = multiprocessing.Pool(nworker,initializer=set_threads,initargs=(worker_threads,))
 for fnm in train_files:
     p = pool.apply_async(extract_one, (train_ori_dir, train_tar_dir, fnm,))  
 pool.close()
@@ -215,7 +217,7 @@ pool.join()
 #         extract_one(valid_ori_dir, valid_tar_dir, fnm)
 #         bar()
 
-pool = multiprocessing.Pool(nworker)
+pool = multiprocessing.Pool(nworker,initializer=set_threads,initargs=(worker_threads,))
 for fnm in valid_files:
     p = pool.apply_async(extract_one, (valid_ori_dir, valid_tar_dir, fnm,))  
 pool.close()
@@ -227,7 +229,7 @@ pool.join()
 #         extract_one(test_ori_dir, test_tar_dir, fnm)
 #         bar()
     
-pool = multiprocessing.Pool(nworker)
+pool = multiprocessing.Pool(nworker,initializer=set_threads,initargs=(worker_threads,))
 for fnm in test_files:
     p = pool.apply_async(extract_one, (test_ori_dir, test_tar_dir, fnm,))  
 pool.close()
@@ -5,11 +5,22 @@ import random
 import pickle
 import gzip
 import os
+import json
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import contextlib
+import torch.distributed as dist
 from alive_progress import alive_bar
-from model import compute_weight_grad
+from model import compute_weight_grad, compute_objective_grad
 from colorama import Fore, Back, Style
 import matplotlib.pyplot as plt
 from model import r_gap_general
+from model import set_spmm_chunk
+from model import q_structure, StructuredQ, SparseOperator, spmm, select_backend, KKTConstants
+from model import pop_host_syncs, host_item
 
 
 def extract(fnm):
@@ -1246,160 +1257,706 @@ def getConfig(ident=''):
     return res_dic
 
 
-def process(m,files,epoch,tar_dir,pareto,device,optimizer,choose_weight=False,autoregression_iteration=1,training=True,accu_loss = True,cur_best=None):
-    if not training:
-        return valid(m,files,epoch,tar_dir,pareto,device,optimizer,autoregression_iteration)
+# rough fp32 footprint used by the execution planner
+ACT_PER_LAYER_X = 12    # n x feat tensors kept for backward by one unrolled layer
+ACT_PER_LAYER_Y = 5     # m x feat tensors kept for backward by one unrolled layer
+BYTES_PER_NNZ = 12      # int64 column index and fp32 value per CSR entry
+BYTES_PER_ROW_IDX = 8   # int64 row index per entry, cached by SparseOperator for A^T@X
+
+
+def load_q(to_pack,key,device):
+    # serve diagonal / banded Q through the elementwise kernel, samples
+    #       extracted before Q_kind was stored are classified here
+    Q = to_pack[key]
+    if not Q.is_sparse:
+        return Q.to(device)
+    if 'Q_kind' in to_pack:
+        Q = StructuredQ.from_sparse(Q,to_pack['Q_kind'],to_pack['Q_bw'])
     else:
-        return train(m,files,epoch,tar_dir,pareto,device,optimizer,choose_weight,autoregression_iteration,accu_loss = accu_loss,cur_best=cur_best)
+        Q = StructuredQ.from_sparse(Q)
+    return Q.to(device)
+
+
+def load_a(to_pack,key,device):
+    # A kept once in CSR, AT = A.t() reuses the same storage
+    A = to_pack[key]
+    if A.layout == torch.strided:
+        return A.to(device)
+    return select_backend(SparseOperator.from_sparse(A).to(device))
+
+
+def set_threads(intra=0,inter=0):
+    # explicit thread counts keep parallel workers from oversubscribing the cores
+    if intra > 0:
+        torch.set_num_threads(intra)
+    if inter > 0:
+        try:
+            torch.set_num_interop_threads(inter)
+        except RuntimeError:
+            print(f'inter-op threads already fixed to {torch.get_num_interop_threads()}')
+
+
+def sparse_nnz(M):
+    if isinstance(M,StructuredQ):
+        return M.nnz
+    if isinstance(M,SparseOperator):
+        return M._nnz()
+    if M.is_sparse:
+        return M._nnz()
+    return M.numel()
+
+
+def model_dims(m):
+    net = getattr(m,'net',m)
+    feat = max(mod.out_features for mod in m.modules() if isinstance(mod,torch.nn.Linear))
+    layers = getattr(net,'updates',None)
+    if layers is None:
+        layers = getattr(net,'c_updates',[])
+    return feat, max(len(layers),1)
+
+
+def memory_budget_mb(device,mem_budget=None):
+    if mem_budget is not None:
+        return mem_budget
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]/1024/1024
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')/1024/1024
+    except (ValueError, OSError, AttributeError):
+        return float('inf')
+
+
+def estimate_memory_mb(n,m,nnz,feat,nlayer,training=True,ckpt_segment=0,chunk=0,offload=False):
+    # A and its unscaled copy stay resident as CSR with their row index, A^T
+    #       shares their storage, Q is part of nnz
+    mats = 2*nnz*(BYTES_PER_NNZ+BYTES_PER_ROW_IDX)
+    width = feat if chunk <= 0 else min(chunk,feat)
+    work = 2*(n+m)*width*4
+    if not training:
+        return (mats + 4*(n+m)*feat*4 + work)/1024/1024
+    layer_act = (ACT_PER_LAYER_X*n + ACT_PER_LAYER_Y*m)*feat*4
+    if offload:
+        # saved activations live in host memory, only one layer is on device
+        return (mats + layer_act + work)/1024/1024
+    if ckpt_segment <= 0:
+        return (mats + nlayer*layer_act + work)/1024/1024
+    nseg = -(-nlayer//ckpt_segment)
+    boundary = (4*n + 2*m)*feat*4
+    return (mats + nseg*boundary + min(ckpt_segment,nlayer)*layer_act + work)/1024/1024
+
+
+def plan_execution(n,m,nnz,feat,nlayer,budget_mb,training=True,device=torch.device('cpu'),ckpt_segment=0,can_ckpt=True):
+    candidates = [('plain',ckpt_segment,0,False)]
+    if training and can_ckpt:
+        best_k = min(range(1,nlayer+1),key=lambda k: estimate_memory_mb(n,m,nnz,feat,nlayer,True,k))
+        candidates.append(('checkpointed',best_k,0,False))
+    chunk = max(1,feat//8)
+    candidates.append(('chunked',candidates[-1][1],chunk,False))
+    if training and device.type == 'cuda':
+        candidates.append(('offloaded',candidates[-1][1],chunk,True))
+
+    est = None
+    for strategy,ckpt,chk,offload in candidates:
+        est = estimate_memory_mb(n,m,nnz,feat,nlayer,training,ckpt,chk,offload)
+        if est <= budget_mb:
+            return {'strategy':strategy,'ckpt':ckpt,'chunk':chk,'offload':offload,'est_mb':est}
+    reason = f'n={n} m={m} nnz={nnz}: needs ~{round(est,1)}MB with {candidates[-1][0]} execution, budget {round(budget_mb,1)}MB'
+    return {'strategy':'skip','reason':reason,'est_mb':est}
+
+
+@contextlib.contextmanager
+def apply_plan(m,plan):
+    # with apply_plan(m,plan): the settings of the plan are undone on exit,
+    #       also when the body raises or returns early
+    # a plain plan touches nothing, so the instances map_instances runs on its
+    #       pool never write net.ckpt_segment or the spmm chunk (other plans are
+    #       deferred until the pool is done)
+    if plan['strategy'] == 'plain':
+        yield
+        return
+    net = getattr(m,'net',None)
+    old_ckpt = getattr(net,'ckpt_segment',None)
+    if old_ckpt is not None:
+        net.ckpt_segment = plan['ckpt']
+    set_spmm_chunk(plan['chunk'])
+    try:
+        if plan['offload']:
+            with torch.autograd.graph.save_on_cpu(pin_memory=True):
+                yield
+        else:
+            yield
+    finally:
+        if old_ckpt is not None:
+            net.ckpt_segment = old_ckpt
+        set_spmm_chunk(0)
 
 
+def log_skip(fnm,reason):
+    print(Fore.YELLOW + f'skipping {fnm}: {reason}' + Style.RESET_ALL)
+    f = open('../logs/skipped_instances.log','a+')
+    f.write(f'{fnm} {reason}\n')
+    f.close()
 
 
-def valid(m,valid_files,epoch,valid_tar_dir,pareto,device,modf,autoregression_iteration):
+def shard_files(files,rank,world):
+    # files of one rank, padded so that every rank runs the same number of steps
+    files = sorted(files)
+    shard = files[rank::world]
+    n = (len(files)+world-1)//world
+    while len(shard) < n:
+        shard.append(files[(rank+len(shard)*world) % len(files)])
+    return shard
+
+
+def reduce_lists(lists):
+    # element-wise sums of lists of floats over the ranks
+    flat = torch.tensor([v for l in lists for v in l],dtype=torch.float64)
+    dist.all_reduce(flat)
+    out = []
+    st = 0
+    for l in lists:
+        out.append(flat[st:st+len(l)].tolist())
+        st += len(l)
+    return out
+
+
+def broadcast_model(m):
+    # start every rank from the parameters of rank 0
+    for t in m.state_dict().values():
+        dist.broadcast(t,0)
+
+
+class DistOptimizer():
+    # data parallel training over gloo, step() averages the gradients of all
+    #       ranks before stepping so the replicas stay identical
+    #       every rank has to call step() equally often
+
+    def __init__(self,optimizer,model):
+        self.optimizer = optimizer
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.world = dist.get_world_size()
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def step(self):
+        # the has-grad mask is reduced with the gradients, parameters no rank
+        #       touched keep grad None so AdamW skips them as it would on one process
+        grads = [torch.zeros_like(p) if p.grad is None else p.grad for p in self.params]
+        has = torch.tensor([0.0 if p.grad is None else 1.0 for p in self.params],dtype=grads[0].dtype,device=grads[0].device)
+        flat = torch.cat([g.reshape(-1) for g in grads]+[has])
+        dist.all_reduce(flat)
+        has = flat[-len(self.params):].tolist()
+        flat = flat[:-len(self.params)]/self.world
+        st = 0
+        for p,h in zip(self.params,has):
+            if h > 0:
+                p.grad = flat[st:st+p.numel()].view_as(p).clone()
+            else:
+                p.grad = None
+            st += p.numel()
+        self.optimizer.step()
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self,state):
+        self.optimizer.load_state_dict(state)
+
+
+class GradAccumulator():
+    # steps the optimizer once every accum_steps backward passes, each loss is
+    #       divided by accum_steps so the step sees their mean
+
+    def __init__(self,optimizer,accum_steps=1):
+        self.optimizer = optimizer
+        self.accum_steps = max(1,accum_steps)
+        self.pending = 0
+        self.steps = 0
+
+    def backward(self,loss):
+        (loss/self.accum_steps).backward()
+        self.done()
+
+    def done(self):
+        # a skipped instance still counts, so ranks of DistOptimizer step together
+        self.pending += 1
+        if self.pending >= self.accum_steps:
+            self.flush()
+
+    def flush(self):
+        if self.pending > 0:
+            self.optimizer.step()
+            self.optimizer.zero_grad()
+            self.pending = 0
+            self.steps += 1
+
+
+def instance_sizes(tar_dir,files):
+    # nnz(A)+nnz(Q) of every sample, cached in ../logs/sizes_{dir}.json so the
+    #       pickles are only opened once
+    path = f'../logs/sizes_{os.path.basename(os.path.normpath(tar_dir))}.json'
+    sizes = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            sizes = json.load(f)
+    missing = sorted(set(f for f in files if f not in sizes))
+    cpu = torch.device('cpu')
+    for fnm in missing:
+        f_tar = gzip.open(f'{tar_dir}/{fnm}','rb')
+        to_pack = pickle.load(f_tar)
+        f_tar.close()
+        sizes[fnm] = int(sparse_nnz(load_a(to_pack,'A',cpu))+sparse_nnz(load_q(to_pack,'Q',cpu)))
+    if len(missing) > 0:
+        # ranks may write it at the same time
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp,'w') as f:
+            json.dump(sizes,f)
+        os.replace(tmp,path)
+    return sizes
+
+
+def curriculum_files(files,sizes,epoch,start,epochs):
+    # the smallest instances first, the admitted fraction grows linearly from
+    #       start at epoch 0 to all files at epoch `epochs`
+    frac = 1.0 if epochs <= 0 else min(1.0,start+(1.0-start)*epoch/epochs)
+    k = max(1,int(np.ceil(frac*len(files))))
+    return sorted(files,key=lambda f:(sizes[f],f))[:k]
+
+
+class PrioritySampler():
+    # draws the files of an epoch with replacement, with probability growing with
+    #       a running relKKT per file, p ~ (loss+eps)^alpha, the losses are weighted
+    #       by (N p)^-beta / max to correct the bias (beta = 1 is fully unbiased)
+
+    def __init__(self,files,alpha=1.0,beta=0.5,decay=0.5,eps=1e-4):
+        self.files = sorted(files)
+        self.alpha = alpha
+        self.beta = beta
+        self.decay = decay
+        self.eps = eps
+        self.loss = {}
+        # device scalars of the last epoch, read back once in draw()
+        self.recent = {}
+
+    def update(self,fnm,loss):
+        self.recent[fnm] = loss.detach() if torch.is_tensor(loss) else loss
+
+    def draw(self,n=None,files=None):
+        for fnm,v in self.recent.items():
+            v = float(v)
+            self.loss[fnm] = v if fnm not in self.loss else self.decay*self.loss[fnm]+(1.0-self.decay)*v
+        self.recent = {}
+        n = len(self.files) if n is None else n
+        if files is not None:
+            self.files = sorted(files)
+        # files not seen yet are drawn as the hardest ones
+        top = max(self.loss.values()) if len(self.loss) > 0 else 1.0
+        pri = np.array([(self.loss.get(f,top)+self.eps)**self.alpha for f in self.files])
+        prob = pri/pri.sum()
+        idx = np.random.choice(len(self.files),size=n,p=prob)
+        w = (len(self.files)*prob[idx])**(-self.beta)
+        w = w/w.max()
+        return [self.files[i] for i in idx], [float(v) for v in w]
+
+    def state_dict(self):
+        for fnm,v in self.recent.items():
+            self.recent[fnm] = float(v)
+        return {'loss':dict(self.loss),'recent':dict(self.recent)}
+
+    def load_state_dict(self,st):
+        self.loss = dict(st['loss'])
+        self.recent = dict(st['recent'])
+
+
+def rng_state():
+    st = {'torch':torch.get_rng_state(),'random':random.getstate(),'numpy':np.random.get_state()}
+    if torch.cuda.is_available():
+        st['cuda'] = torch.cuda.get_rng_state_all()
+    return st
+
+
+def set_rng_state(st):
+    torch.set_rng_state(st['torch'])
+    random.setstate(st['random'])
+    np.random.set_state(st['numpy'])
+    if 'cuda' in st and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(st['cuda'])
+
+
+def cpu_copy(obj):
+    # snapshot of a (nested) state dict that later steps cannot modify
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu',copy=True)
+    if isinstance(obj,dict):
+        return {k:cpu_copy(v) for k,v in obj.items()}
+    if isinstance(obj,(list,tuple)):
+        return type(obj)(cpu_copy(v) for v in obj)
+    return obj
+
+
+def list_checkpoints(prefix):
+    # periodic checkpoints {prefix}{epoch}.mdl, oldest first
+    d = os.path.dirname(prefix)
+    base = os.path.basename(prefix)
+    res = []
+    if not os.path.isdir(d):
+        return res
+    for f in os.listdir(d):
+        if f.startswith(base) and f.endswith('.mdl') and f[len(base):-4].isdigit():
+            res.append((int(f[len(base):-4]),f'{d}/{f}'))
+    res.sort()
+    return [f for e,f in res]
+
+
+class CheckpointWriter():
+    # torch.save on a background thread, the state is copied on the caller's
+    #       thread and written to path.tmp then renamed, so a crash never leaves
+    #       a partial file, keep > 0 retains only the newest periodic checkpoints
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def save(self,state,path,prefix=None,keep=0):
+        self.queue.put((cpu_copy(state),path,prefix,keep))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            state,path,prefix,keep = job
+            torch.save(state,path+'.tmp')
+            os.replace(path+'.tmp',path)
+            if prefix is not None and keep > 0:
+                for f in list_checkpoints(prefix)[:-keep]:
+                    os.remove(f)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class MetricsSink():
+    # records are queued by the training loop as they are and written by a
+    #       background thread every interval seconds, tensors are read back there
+    #       so the loop itself never waits on the device or the terminal
+
+    def __init__(self,path,interval=5.0):
+        self.path = path
+        self.interval = interval
+        self.fields = None
+        self.queue = queue.Queue()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def log(self,record):
+        self.queue.put(record)
+
+    def write(self):
+        recs = []
+        while True:
+            try:
+                recs.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if len(recs) == 0:
+            return
+        f = open(self.path,'a')
+        for rec in recs:
+            rec = {k:(v.item() if torch.is_tensor(v) else v) for k,v in rec.items()}
+            if self.path.endswith('.csv'):
+                if self.fields is None:
+                    self.fields = ['phase','epoch','file','loss','relkkt','primal','dual','gap','valid_loss','step_time','peak_mem','host_syncs']
+                    if f.tell() == 0:
+                        f.write(','.join(self.fields)+'\n')
+                f.write(','.join(str(rec.get(k,'')) for k in self.fields)+'\n')
+            else:
+                f.write(json.dumps(rec)+'\n')
+        f.close()
 
-    avg_valid_loss = [0.0]*autoregression_iteration
-    avg_sc = [0.0]*autoregression_iteration
-    avg_scprimal = [0.0]*autoregression_iteration
-    avg_scdual = [0.0]*autoregression_iteration
-    avg_scgap = [0.0]*autoregression_iteration
-    avg_hist = None
-    with torch.no_grad():
-        with alive_bar(len(valid_files),title=f"Validating epoch {epoch}") as bar:
-            for fnm in valid_files:
-                f_tar = gzip.open(f'{valid_tar_dir}/{fnm}','rb')
-                to_pack = pickle.load(f_tar)
-                v_feat = to_pack['vf'].to(device)
-                c_feat = to_pack['cf'].to(device)
-                Q = to_pack['Q'].to(device)
-                A = to_pack['A'].to(device)
-                AT = torch.transpose(A,0,1)
-                c = to_pack['c'].to(device)
-                b = to_pack['b'].to(device)
-                c = torch.unsqueeze(c,-1)
-                b = torch.unsqueeze(b,-1)
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.write()
+        self.write()
 
-                Q_ori = to_pack['Q_ori'].to(device)
-                A_ori = to_pack['A_ori'].to(device)
-                AT_ori = torch.transpose(A_ori,0,1)
-                c_ori = to_pack['c_ori'].to(device)
-                b_ori = to_pack['b_ori'].to(device)
-                c_ori = torch.unsqueeze(c_ori,-1)
-                b_ori = torch.unsqueeze(b_ori,-1)
-                var_lb_ori = torch.as_tensor(to_pack['var_lb_ori'], dtype=torch.float32).to(device)
-                var_ub_ori = torch.as_tensor(to_pack['var_ub_ori'], dtype=torch.float32).to(device)
+    def close(self):
+        self.stop.set()
+        self.thread.join()
 
-                vscale = torch.as_tensor(to_pack['vscale']).to(device).unsqueeze(-1)
-                cscale = torch.as_tensor(to_pack['cscale'] ).to(device).unsqueeze(-1)
-                constscale = torch.as_tensor(to_pack['constscale']).to(device).unsqueeze(-1)
-                cons_ident = torch.as_tensor(to_pack['cons_ident'], dtype=torch.float32).to(device)
-                vars_ident_l = torch.as_tensor(to_pack['vars_ident_l'], dtype=torch.float32).to(device)
-                vars_ident_u = torch.as_tensor(to_pack['vars_ident_u'], dtype=torch.float32).to(device)
-                var_lb = torch.as_tensor(to_pack['var_lb'], dtype=torch.float32).to(device)
-                var_ub = torch.as_tensor(to_pack['var_ub'], dtype=torch.float32).to(device)
-                f_tar.close()
-                
-                if cons_ident.shape[-1]!=1:
-                    cons_ident = cons_ident.unsqueeze(-1)
-                if vars_ident_l.shape[-1]!=1:
-                    vars_ident_l = vars_ident_l.unsqueeze(-1)
-                if vars_ident_u.shape[-1]!=1:
-                    vars_ident_u = vars_ident_u.unsqueeze(-1)
-                if var_lb.shape[-1]!=1:
-                    var_lb = var_lb.unsqueeze(-1)
-                if var_ub.shape[-1]!=1:
-                    var_ub = var_ub.unsqueeze(-1)
-                if var_lb_ori.shape[-1]!=1:
-                    var_lb_ori = var_lb_ori.unsqueeze(-1)
-                if var_ub_ori.shape[-1]!=1:
-                    var_ub_ori = var_ub_ori.unsqueeze(-1)
-                    
-                    
-                v_feat = torch.zeros((v_feat.shape[0],1),dtype=torch.float32).to(device)
-                c_feat = torch.zeros((c_feat.shape[0],1),dtype=torch.float32).to(device)
-                
-                if v_feat.shape[0] > 100000 or v_feat.shape[0] > 100000:
-                    continue
 
-                avg_histx = None
-                avg_histy = None
+def process(m,files,epoch,tar_dir,pareto,device,optimizer,choose_weight=False,autoregression_iteration=1,training=True,accu_loss = True,cur_best=None,stats=None,mem_budget=None,sink=None,accum_steps=1,sampler=None,workers=1,task_threads=0,sync_debug=False):
+    if not training:
+        return valid(m,files,epoch,tar_dir,pareto,device,optimizer,autoregression_iteration,mem_budget=mem_budget,sink=sink,workers=workers,task_threads=task_threads)
+    else:
+        return train(m,files,epoch,tar_dir,pareto,device,optimizer,choose_weight,autoregression_iteration,accu_loss = accu_loss,cur_best=cur_best,stats=stats,mem_budget=mem_budget,sink=sink,accum_steps=accum_steps,sampler=sampler,sync_debug=sync_debug)
 
-                for itr in range(autoregression_iteration):
-                    if avg_histx is not None:
-                        v_feat = avg_histx
-                        c_feat = avg_histy
-                    # print(Fore.RED + f'{itr} {v_feat.shape}'+Style.RESET_ALL)
-                    x_pred,y_pred,scs_all,mult,avg_histx,avg_histy = m(AT,A,Q,b,c,v_feat,c_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub, 
-                                                   AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori)
 
-                    if type(scs_all) == type((1,2)):
-                        scs = scs_all[0]
-                    else:
-                        scs = scs_all
 
-                    bqual_ori = b_ori.squeeze(-1).to(device)
-                    cqual_ori = c_ori.squeeze(-1).to(device)
-                    ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x_pred,y_pred,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale)
-                    print(f'primal_res: {prim_res.item()}   dual_res: {dual_res.item()}   gaps: {gaps.item()}')
-                    real_sc = torch.max(prim_res,torch.max(dual_res,gaps))
-                    real_sc_num = real_sc.item()
-                    avg_sc[itr] += real_sc_num
 
-                    avg_scprimal[itr] += prim_res.item()
-                    avg_scdual[itr] += dual_res.item()
-                    avg_scgap[itr] += gaps.item()
+def map_instances(fn,files,workers=1,task_threads=0,bar=None):
+    # fn(fnm,defer) over independent instances for no_grad passes, on a thread
+    #       pool when workers > 1 (torch releases the GIL in its kernels), each
+    #       task capped at task_threads intra-op threads, results in file order
+    #       a task returns 'defer' when its plan changes global state (chunked
+    #       products, offload), those run one by one after the pool
+    if workers <= 1:
+        res = []
+        for fnm in files:
+            res.append(fn(fnm,False))
+            if bar is not None:
+                bar()
+        return res
+
+    def task(fnm):
+        # grad mode is thread local
+        with torch.no_grad():
+            return fn(fnm,True)
+    old_threads = torch.get_num_threads()
+    res = []
+    with ThreadPoolExecutor(workers,initializer=set_threads,initargs=(task_threads,)) as pool:
+        futures = [pool.submit(task,fnm) for fnm in files]
+        for fu in futures:
+            res.append(fu.result())
+    torch.set_num_threads(old_threads)
+    for i,fnm in enumerate(files):
+        if isinstance(res[i],str) and res[i] == 'defer':
+            res[i] = fn(fnm,False)
+        if bar is not None:
+            bar()
+    return res
 
-                    loss = scs
-                    loss = (itr*loss)/autoregression_iteration
-                    loss_num = scs.item()
-                    avg_valid_loss[itr] += loss_num
 
+def valid_one(m,fnm,epoch,valid_tar_dir,device,modf,autoregression_iteration,budget_mb,sink=None,defer=False):
+    # one validation instance: (loss, relkkt, primal, dual, gap) per AR iteration,
+    #       None when skipped by the planner
+    f_tar = gzip.open(f'{valid_tar_dir}/{fnm}','rb')
+    to_pack = pickle.load(f_tar)
+    v_feat = to_pack['vf'].to(device)
+    c_feat = to_pack['cf'].to(device)
+    Q = load_q(to_pack,'Q',device)
+    A = load_a(to_pack,'A',device)
+    AT = A.t()
+    c = to_pack['c'].to(device)
+    b = to_pack['b'].to(device)
+    c = torch.unsqueeze(c,-1)
+    b = torch.unsqueeze(b,-1)
 
-                    v_feat = x_pred.detach().clone()
-                    c_feat = y_pred.detach().clone()
+    Q_ori = load_q(to_pack,'Q_ori',device)
+    A_ori = load_a(to_pack,'A_ori',device)
+    AT_ori = A_ori.t()
+    c_ori = to_pack['c_ori'].to(device)
+    b_ori = to_pack['b_ori'].to(device)
+    c_ori = torch.unsqueeze(c_ori,-1)
+    b_ori = torch.unsqueeze(b_ori,-1)
+    var_lb_ori = torch.as_tensor(to_pack['var_lb_ori'], dtype=torch.float32).to(device)
+    var_ub_ori = torch.as_tensor(to_pack['var_ub_ori'], dtype=torch.float32).to(device)
 
-                    
+    vscale = torch.as_tensor(to_pack['vscale']).to(device).unsqueeze(-1)
+    cscale = torch.as_tensor(to_pack['cscale'] ).to(device).unsqueeze(-1)
+    constscale = torch.as_tensor(to_pack['constscale']).to(device).unsqueeze(-1)
+    cons_ident = torch.as_tensor(to_pack['cons_ident'], dtype=torch.float32).to(device)
+    vars_ident_l = torch.as_tensor(to_pack['vars_ident_l'], dtype=torch.float32).to(device)
+    vars_ident_u = torch.as_tensor(to_pack['vars_ident_u'], dtype=torch.float32).to(device)
+    var_lb = torch.as_tensor(to_pack['var_lb'], dtype=torch.float32).to(device)
+    var_ub = torch.as_tensor(to_pack['var_ub'], dtype=torch.float32).to(device)
+    f_tar.close()
+    
+    if cons_ident.shape[-1]!=1:
+        cons_ident = cons_ident.unsqueeze(-1)
+    if vars_ident_l.shape[-1]!=1:
+        vars_ident_l = vars_ident_l.unsqueeze(-1)
+    if vars_ident_u.shape[-1]!=1:
+        vars_ident_u = vars_ident_u.unsqueeze(-1)
+    if var_lb.shape[-1]!=1:
+        var_lb = var_lb.unsqueeze(-1)
+    if var_ub.shape[-1]!=1:
+        var_ub = var_ub.unsqueeze(-1)
+    if var_lb_ori.shape[-1]!=1:
+        var_lb_ori = var_lb_ori.unsqueeze(-1)
+    if var_ub_ori.shape[-1]!=1:
+        var_ub_ori = var_ub_ori.unsqueeze(-1)
+    consts = KKTConstants(Q_ori,b_ori.squeeze(-1),c_ori.squeeze(-1),vscale,cscale,constscale,cons_ident,vars_ident_l,vars_ident_u)
+        
+        
+    v_feat = torch.zeros((v_feat.shape[0],1),dtype=torch.float32).to(device)
+    c_feat = torch.zeros((c_feat.shape[0],1),dtype=torch.float32).to(device)
+    
+    feat, nlayer = model_dims(m)
+    plan = plan_execution(v_feat.shape[0],c_feat.shape[0],sparse_nnz(A)+sparse_nnz(Q),feat,nlayer,budget_mb,training=False,device=device)
+    if plan['strategy'] == 'skip':
+        log_skip(fnm,plan['reason'])
+        return None
+    if plan['strategy'] != 'plain' and defer:
+        return 'defer'
+    with apply_plan(m,plan):
+        res = []
+
+        avg_histx = None
+        avg_histy = None
+
+        for itr in range(autoregression_iteration):
+            if avg_histx is not None:
+                v_feat = avg_histx
+                c_feat = avg_histy
+            # print(Fore.RED + f'{itr} {v_feat.shape}'+Style.RESET_ALL)
+            x_pred,y_pred,scs_all,mult,avg_histx,avg_histy = m(AT,A,Q,b,c,v_feat,c_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub, 
+                                           AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori,consts=consts)
+
+            if type(scs_all) == type((1,2)):
+                scs = scs_all[0]
+            else:
+                scs = scs_all
 
-                    print(f'Auto-regression on {fnm}, iteration {itr} loss:{loss_num}     real sc:{real_sc_num}')
-                bar()
-                
-    return avg_valid_loss, avg_sc, avg_scprimal, avg_scdual, avg_scgap
+            bqual_ori = b_ori.squeeze(-1).to(device)
+            cqual_ori = c_ori.squeeze(-1).to(device)
+            ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x_pred,y_pred,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale,consts=consts)
+            real_sc = torch.max(prim_res,torch.max(dual_res,gaps))
+            # summed on device by valid, read back once at the end of the epoch
+            res.append((scs,real_sc,prim_res,dual_res,gaps))
 
 
-def compute_obj(Q,c,x,y):
+            v_feat = x_pred.detach().clone()
+            c_feat = y_pred.detach().clone()
 
-    c = c.squeeze(-1)
+        
 
-    print(Q.shape,x.shape)
-    r1 = torch.sparse.mm(Q,x).squeeze(-1)
-    print(f'r1 shape: {r1.shape}')
-    r1 = torch.matmul(r1,x.squeeze(-1))
-    print(f'r1 shape: {r1.shape}')
+            if sink is None:
+                print(f'primal_res: {prim_res.item()}   dual_res: {dual_res.item()}   gaps: {gaps.item()}')
+                print(f'Auto-regression on {fnm}, iteration {itr} loss:{scs.item()}     real sc:{real_sc.item()}')
+        if sink is not None:
+            sink.log({'phase':'valid','epoch':epoch,'file':fnm,'loss':scs,'relkkt':real_sc,'primal':prim_res,'dual':dual_res,'gap':gaps})
+    return res
 
-    r2 = torch.matmul(c,x.squeeze(-1))
-    print(r2.shape)
 
-    print(r1+r2)
+def valid(m,valid_files,epoch,valid_tar_dir,pareto,device,modf,autoregression_iteration,mem_budget=None,sink=None,workers=1,task_threads=0):
 
-    print(x,torch.max(x))
-    print(y,torch.max(y))
+    budget_mb = memory_budget_mb(device,mem_budget)
+    avg_valid_loss = [0.0]*autoregression_iteration
+    avg_sc = [0.0]*autoregression_iteration
+    avg_scprimal = [0.0]*autoregression_iteration
+    avg_scdual = [0.0]*autoregression_iteration
+    avg_scgap = [0.0]*autoregression_iteration
+    with torch.no_grad():
+        with alive_bar(len(valid_files),title=f"Validating epoch {epoch}") as bar:
+            results = map_instances(lambda fnm,defer: valid_one(m,fnm,epoch,valid_tar_dir,device,modf,autoregression_iteration,budget_mb,sink=sink,defer=defer),
+                                    valid_files,workers,task_threads,bar)
+    for res in results:
+        if res is None:
+            continue
+        for itr,(scs,real_sc,prim_res,dual_res,gaps) in enumerate(res):
+            avg_sc[itr] += real_sc
+            avg_scprimal[itr] += prim_res
+            avg_scdual[itr] += dual_res
+            avg_scgap[itr] += gaps
+            avg_valid_loss[itr] += scs
+                
+    return [float(v) for v in avg_valid_loss], [float(v) for v in avg_sc], [float(v) for v in avg_scprimal], [float(v) for v in avg_scdual], [float(v) for v in avg_scgap]
+
+
+def valid_subset(valid_files,fraction,epoch):
+    # seeded by the epoch and not by the training rng, so resumed runs see the same files
+    if fraction >= 1.0:
+        return valid_files
+    k = max(1,int(round(len(valid_files)*fraction)))
+    return random.Random(epoch).sample(sorted(valid_files),k)
+
+
+def valid_worker(m,jobs,results,valid_tar_dir,modf,autoregression_iteration,threads,metrics_path):
+    set_threads(threads)
+    sink = MetricsSink(metrics_path) if metrics_path is not None else None
+    device = torch.device('cpu')
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch,params,files = job
+        try:
+            m.load_state_dict(params)
+            res = valid(m,files,epoch,valid_tar_dir,False,device,modf,autoregression_iteration,sink=sink)
+            results.put((epoch,len(files),res,None))
+        except Exception as e:
+            # reported to the trainer, the worker keeps serving later epochs
+            results.put((epoch,len(files),None,f'{type(e).__name__}: {e}'))
+    if sink is not None:
+        sink.close()
+
+
+class AsyncValidator():
+    # validation on a forked cpu process, the trainer hands over a parameter
+    #       snapshot and keeps training, poll() returns the scores together with
+    #       the snapshot they belong to so the best model can still be saved
+    #       fork and not spawn: train_new.py has no main guard to re-import safely,
+    #       so it has to be created before the trainer starts its helper threads
+
+    def __init__(self,m,valid_tar_dir,modf,autoregression_iteration,threads=1,metrics_path=None,timeout=10.0):
+        self.timeout = timeout
+        ctx = multiprocessing.get_context('fork')
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.pending = {}
+        worker_m = copy.deepcopy(m).cpu()
+        self.proc = ctx.Process(target=valid_worker,args=(worker_m,self.jobs,self.results,valid_tar_dir,modf,autoregression_iteration,threads,metrics_path),daemon=True)
+        self.proc.start()
+
+    def submit(self,epoch,state,files):
+        state = cpu_copy(state)
+        self.pending[epoch] = state
+        self.jobs.put((epoch,state['model'],files))
+
+    def poll(self,block=False):
+        # block waits for every pending epoch, a dead worker raises instead of hanging
+        done = []
+        while len(self.pending) > 0:
+            try:
+                if block:
+                    epoch,nfiles,res,err = self.results.get(timeout=self.timeout)
+                else:
+                    epoch,nfiles,res,err = self.results.get_nowait()
+            except queue.Empty:
+                if not self.proc.is_alive():
+                    raise RuntimeError(f'validation worker exited with code {self.proc.exitcode}, epochs {sorted(self.pending)} not validated')
+                if block:
+                    continue
+                break
+            snapshot = self.pending.pop(epoch)
+            if err is not None:
+                print(Fore.RED + f'validation of epoch {epoch} failed: {err}' + Style.RESET_ALL)
+                continue
+            done.append((epoch,nfiles,res,snapshot))
+        return done
 
+    def close(self):
+        if self.proc.is_alive():
+            self.jobs.put(None)
+        self.proc.join()
 
-    quit()
+
+def compute_obj(Q,c,x,y):
+    # x'Qx + c'x of the predicted primal, spmm covers sparse and structured Q
+    x = x.squeeze(-1)
+    r1 = torch.dot(spmm(Q,x.unsqueeze(-1)).squeeze(-1),x)
+    r2 = torch.dot(c.squeeze(-1),x)
+    return r1+r2
 
 import time
 
-def inference(m,fnm,epoch,valid_tar_dir,pareto,device,modf,autoregression_iteration):
+def inference(m,fnm,epoch,valid_tar_dir,pareto,device,modf,autoregression_iteration,mem_budget=None,defer=False,sink=None):
     f_tar = gzip.open(f'{valid_tar_dir}/{fnm}','rb')
     to_pack = pickle.load(f_tar)
     v_feat = to_pack['vf'].to(device)
     c_feat = to_pack['cf'].to(device)
-    Q = to_pack['Q'].to(device)
-    A = to_pack['A'].to(device)
+    Q = load_q(to_pack,'Q',device)
+    A = load_a(to_pack,'A',device)
     
-    print('NNZ',A._nnz())
+    if sink is None:
+        print('NNZ',sparse_nnz(A))
     # quit()
     
-    AT = torch.transpose(A,0,1)
+    AT = A.t()
     c = to_pack['c'].to(device)
     b = to_pack['b'].to(device)
     x = to_pack['x'].to(device)
@@ -1407,9 +1964,9 @@ def inference(m,fnm,epoch,valid_tar_dir,pareto,device,modf,autoregression_iterat
     c = torch.unsqueeze(c,-1)
     b = torch.unsqueeze(b,-1)
 
-    Q_ori = to_pack['Q_ori'].to(device)
-    A_ori = to_pack['A_ori'].to(device)
-    AT_ori = torch.transpose(A_ori,0,1)
+    Q_ori = load_q(to_pack,'Q_ori',device)
+    A_ori = load_a(to_pack,'A_ori',device)
+    AT_ori = A_ori.t()
     c_ori = to_pack['c_ori'].to(device)
     b_ori = to_pack['b_ori'].to(device)
     c_ori = torch.unsqueeze(c_ori,-1)
@@ -1440,11 +1997,17 @@ def inference(m,fnm,epoch,valid_tar_dir,pareto,device,modf,autoregression_iterat
         var_lb_ori = var_lb_ori.unsqueeze(-1)
     if var_ub_ori.shape[-1]!=1:
         var_ub_ori = var_ub_ori.unsqueeze(-1)
+    consts = KKTConstants(Q_ori,b_ori.squeeze(-1),c_ori.squeeze(-1),vscale,cscale,constscale,cons_ident,vars_ident_l,vars_ident_u)
     # in this version, use all 0 start
     v_feat = torch.zeros((v_feat.shape[0],1),dtype=torch.float32).to(device)
     c_feat = torch.zeros((c_feat.shape[0],1),dtype=torch.float32).to(device)
-    print(v_feat.shape[0], c_feat.shape[0])
-    if v_feat.shape[0] > 1500000:
+    if sink is None:
+        print(v_feat.shape[0], c_feat.shape[0])
+    feat, nlayer = model_dims(m)
+    plan = plan_execution(v_feat.shape[0],c_feat.shape[0],sparse_nnz(A)+sparse_nnz(Q),feat,nlayer,memory_budget_mb(device,mem_budget),training=False,device=device)
+    if plan['strategy'] == 'skip':
+        # nothing fits the budget, fall back to the all-zero start
+        log_skip(fnm,plan['reason'])
         ff = open(f'../predictions/primal_{fnm}.sol','w')
         st=''
         for xv in v_feat:
@@ -1466,42 +2029,44 @@ def inference(m,fnm,epoch,valid_tar_dir,pareto,device,modf,autoregression_iterat
         ff.write(st)
         ff.close()
         return
-
-        
-    avg_histx = None
-    avg_histy = None
-    for itr in range(autoregression_iteration):
-        if avg_histx is not None:
-            v_feat = avg_histx
-            c_feat = avg_histy
-        otime = time.time()
-        x_pred,y_pred,scs,mult,avg_histx,avg_histy = m(AT,A,Q,b,c,v_feat,c_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub,
-                                                   AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori)
-        print(f'!!!!!!!!!!!!!!!!!   Inference time: {otime-time.time()}')
-        bqual = b.squeeze(-1)
-        cqual = c.squeeze(-1)
-
-        bqual_ori = b_ori.squeeze(-1).to(device)
-        cqual_ori = c_ori.squeeze(-1).to(device)
-
-        # ttloss, prim_res, dual_res, gaps = modf(Q,A,AT,bqual,cqual,x_pred,y_pred,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub,
-        #                                            AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori)
-        ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x_pred,y_pred,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale)
-        print(fnm) 
-        print(f'primal_res: {prim_res.item()}_{itr}   dual_res: {dual_res.item()}   gaps: {gaps.item()}')
-        azv = torch.zeros(x_pred.shape).to(device)
-        print(f'    l2 norm err: {torch.norm(x_pred-x,2)}      0\'s l2 norm err: {torch.norm(azv-x,2)}\n\n')
-
-        v_feat = x_pred.detach().clone()
-        c_feat = y_pred.detach().clone()
+    if plan['strategy'] != 'plain' and defer:
+        return 'defer'
+
+    with apply_plan(m,plan):
+        avg_histx = None
+        avg_histy = None
+        for itr in range(autoregression_iteration):
+            if avg_histx is not None:
+                v_feat = avg_histx
+                c_feat = avg_histy
+            otime = time.time()
+            x_pred,y_pred,scs,mult,avg_histx,avg_histy = m(AT,A,Q,b,c,v_feat,c_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub,
+                                                       AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori,consts=consts)
+            print(f'!!!!!!!!!!!!!!!!!   Inference time: {otime-time.time()}')
+            bqual = b.squeeze(-1)
+            cqual = c.squeeze(-1)
+
+            bqual_ori = b_ori.squeeze(-1).to(device)
+            cqual_ori = c_ori.squeeze(-1).to(device)
+
+            # ttloss, prim_res, dual_res, gaps = modf(Q,A,AT,bqual,cqual,x_pred,y_pred,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub,
+            #                                            AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori)
+            ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x_pred,y_pred,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale,consts=consts)
+            print(fnm) 
+            print(f'primal_res: {prim_res.item()}_{itr}   dual_res: {dual_res.item()}   gaps: {gaps.item()}')
+            azv = torch.zeros(x_pred.shape).to(device)
+            print(f'    l2 norm err: {torch.norm(x_pred-x,2)}      0\'s l2 norm err: {torch.norm(azv-x,2)}\n\n')
+
+            v_feat = x_pred.detach().clone()
+            c_feat = y_pred.detach().clone()
 
 
     # compute possible primal_weight
-    ATy = torch.sparse.mm(AT,y) 
+    ATy = spmm(AT,y) 
     print(ATy.shape,c.shape)
     delta_x = -c+ATy
 
-    delta_y = torch.sparse.mm(A,delta_x)-b
+    delta_y = spmm(A,delta_x)-b
     pw = torch.norm(delta_x,2)/torch.norm(delta_y,2).item()
     print(pw)
     
@@ -1551,9 +2116,9 @@ def sol_check(fdir,device,modf,pert=None):
     to_pack = pickle.load(f_tar)
     v_feat = to_pack['vf'].to(device)
     c_feat = to_pack['cf'].to(device)
-    Q = to_pack['Q'].to(device)
-    A = to_pack['A'].to(device)
-    AT = torch.transpose(A,0,1)
+    Q = load_q(to_pack,'Q',device)
+    A = load_a(to_pack,'A',device)
+    AT = A.t()
     c = to_pack['c'].to(device)
     b = to_pack['b'].to(device)
     x = to_pack['x']
@@ -1571,9 +2136,9 @@ def sol_check(fdir,device,modf,pert=None):
     x = x.to(device)
     y = y.to(device)
 
-    Q_ori = to_pack['Q_ori'].to(device)
-    A_ori = to_pack['A_ori'].to(device)
-    AT_ori = torch.transpose(A_ori,0,1)
+    Q_ori = load_q(to_pack,'Q_ori',device)
+    A_ori = load_a(to_pack,'A_ori',device)
+    AT_ori = A_ori.t()
     c_ori = to_pack['c_ori'].to(device)
     b_ori = to_pack['b_ori'].to(device)
     c_ori = torch.unsqueeze(c_ori,-1)
@@ -1604,6 +2169,7 @@ def sol_check(fdir,device,modf,pert=None):
         var_lb_ori = var_lb_ori.unsqueeze(-1)
     if var_ub_ori.shape[-1]!=1:
         var_ub_ori = var_ub_ori.unsqueeze(-1)
+    consts = KKTConstants(Q_ori,b_ori.squeeze(-1),c_ori.squeeze(-1),vscale,cscale,constscale,cons_ident,vars_ident_l,vars_ident_u)
     # in this version, use all 0 start
     v_feat = torch.zeros((v_feat.shape[0],1),dtype=torch.float32).to(device)
     c_feat = torch.zeros((c_feat.shape[0],1),dtype=torch.float32).to(device)
@@ -1611,7 +2177,7 @@ def sol_check(fdir,device,modf,pert=None):
 
     bqual_ori = b_ori.squeeze(-1).to(device)
     cqual_ori = c_ori.squeeze(-1).to(device)
-    ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x,y,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale)
+    ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x,y,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale,consts=consts)
     # print(x)
     # print(y)
     print('primal_res',prim_res)
@@ -1634,9 +2200,9 @@ def sol_check_model(fdir,device,modf,model):
     to_pack = pickle.load(f_tar)
     v_feat = to_pack['vf'].to(device)
     c_feat = to_pack['cf'].to(device)
-    Q = to_pack['Q'].to(device)
-    A = to_pack['A'].to(device)
-    AT = torch.transpose(A,0,1)
+    Q = load_q(to_pack,'Q',device)
+    A = load_a(to_pack,'A',device)
+    AT = A.t()
     c = to_pack['c'].to(device)
     b = to_pack['b'].to(device)
     x_ori = to_pack['x']
@@ -1648,9 +2214,9 @@ def sol_check_model(fdir,device,modf,model):
     x_ori = x_ori.to(device)
     y_ori = y_ori.to(device)
 
-    Q_ori = to_pack['Q_ori'].to(device)
-    A_ori = to_pack['A_ori'].to(device)
-    AT_ori = torch.transpose(A_ori,0,1)
+    Q_ori = load_q(to_pack,'Q_ori',device)
+    A_ori = load_a(to_pack,'A_ori',device)
+    AT_ori = A_ori.t()
     c_ori = to_pack['c_ori'].to(device)
     b_ori = to_pack['b_ori'].to(device)
     c_ori = torch.unsqueeze(c_ori,-1)
@@ -1681,17 +2247,18 @@ def sol_check_model(fdir,device,modf,model):
         var_lb_ori = var_lb_ori.unsqueeze(-1)
     if var_ub_ori.shape[-1]!=1:
         var_ub_ori = var_ub_ori.unsqueeze(-1)
+    consts = KKTConstants(Q_ori,b_ori.squeeze(-1),c_ori.squeeze(-1),vscale,cscale,constscale,cons_ident,vars_ident_l,vars_ident_u)
     # in this version, use all 0 start
     v_feat = torch.zeros((v_feat.shape[0],1),dtype=torch.float32).to(device)
     c_feat = torch.zeros((c_feat.shape[0],1),dtype=torch.float32).to(device)
     x,y,scs,mult = model(AT,A,Q,b,c,v_feat,c_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub,
-                                                AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori)
+                                                AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori,consts=consts)
 
 
 
     bqual_ori = b_ori.squeeze(-1).to(device)
     cqual_ori = c_ori.squeeze(-1).to(device)
-    ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x,y,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale)
+    ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x,y,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale,consts=consts)
     # print(x)
     # print(y)
     print('primal_res',prim_res)
@@ -1709,22 +2276,121 @@ def sol_check_model(fdir,device,modf,model):
     return x,y,ttloss,prim_res,dual_res,gaps,x_norm,y_norm
 
 
+def load_kkt_instance(fdir,device):
+    # everything modf needs for one sample, loaded once
+    f_tar = gzip.open(f'{fdir}','rb')
+    to_pack = pickle.load(f_tar)
+    f_tar.close()
+    inst = {}
+    inst['Q'] = load_q(to_pack,'Q_ori',device)
+    inst['A'] = load_a(to_pack,'A_ori',device)
+    inst['AT'] = inst['A'].t()
+    inst['b'] = to_pack['b_ori'].to(device)
+    inst['c'] = to_pack['c_ori'].to(device)
+    inst['x'] = to_pack['x'].to(device)
+    inst['y'] = to_pack['y'].to(device)
+    for key,src in [('l','var_lb_ori'),('u','var_ub_ori'),('Iy','cons_ident'),('il','vars_ident_l'),('iu','vars_ident_u')]:
+        t = torch.as_tensor(to_pack[src], dtype=torch.float32).to(device)
+        if t.shape[-1]!=1:
+            t = t.unsqueeze(-1)
+        inst[key] = t
+    for key in ['vscale','cscale','constscale']:
+        inst[key] = torch.as_tensor(to_pack[key]).to(device).unsqueeze(-1)
+    inst['consts'] = KKTConstants(inst['Q'],inst['b'],inst['c'],inst['vscale'],inst['cscale'],inst['constscale'],inst['Iy'],inst['il'],inst['iu'])
+    return inst
+
+
+def kkt_eval(inst,modf,x,y):
+    # x (n,K) and y (m,K) in the scaled space of the sample, one residual per column
+    return modf(inst['Q'],inst['A'],inst['AT'],inst['b'],inst['c'],x,y,inst['Iy'],inst['il'],inst['iu'],inst['l'],inst['u'],
+                inst['vscale'],inst['cscale'],inst['constscale'],consts=inst['consts'])
+
+
+def read_sol(fnm,device=torch.device('cpu')):
+    # .sol files written by inference, values separated by spaces
+    f = open(fnm,'r')
+    vals = [float(v) for v in f.read().split()]
+    f.close()
+    return torch.as_tensor(vals,dtype=torch.float32).to(device).unsqueeze(-1)
+
+
+cpu_peak_mb = 0.0
+
+def current_rss_mb():
+    # resident set size from /proc, None where it is not available
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages*os.sysconf('SC_PAGE_SIZE')/1024/1024
+    except (OSError,ValueError,IndexError):
+        return None
+
+
+def reset_peak_memory(device):
+    global cpu_peak_mb
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        cpu_peak_mb = current_rss_mb() or 0.0
+
+
+def sample_memory(device):
+    # cpu has no allocator peak, so the rss is sampled after every forward and
+    #       backward pass of train(), where the activations are largest
+    global cpu_peak_mb
+    if device.type != 'cuda':
+        rss = current_rss_mb()
+        if rss is not None:
+            cpu_peak_mb = max(cpu_peak_mb,rss)
+
+
+def peak_memory_mb(device):
+    # peak since reset_peak_memory, on cpu the largest sampled rss, or the
+    #       process lifetime maximum (ru_maxrss) without /proc
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)/1024/1024
+    if current_rss_mb() is not None:
+        return cpu_peak_mb
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+    except ImportError:
+        return 0.0
+
+
 check_grad=False
 # check_grad=True
-def train(m,train_files,epoch,train_tar_dir,pareto,device,optimizer,choose_weight,autoregression_iteration,accu_loss,cur_best):
+def train(m,train_files,epoch,train_tar_dir,pareto,device,optimizer,choose_weight,autoregression_iteration,accu_loss,cur_best,stats=None,mem_budget=None,sink=None,accum_steps=1,sampler=None,sync_debug=False):
     avg_train_loss = [0.0]*autoregression_iteration
-    random.shuffle(train_files)
-    with alive_bar(len(train_files),title=f"Training epoch {epoch}........ Current Best: {cur_best}") as bar:
-        for fnm in train_files:
+    feat, nlayer = model_dims(m)
+    budget_mb = memory_budget_mb(device,mem_budget)
+    can_ckpt = hasattr(getattr(m,'net',None),'ckpt_segment')
+    cur_ckpt = getattr(getattr(m,'net',None),'ckpt_segment',0)
+    if sampler is not None:
+        epoch_files,weights = sampler.draw(len(train_files),train_files)
+    else:
+        random.shuffle(train_files)
+        epoch_files,weights = train_files,[1.0]*len(train_files)
+    step_time = 0.0
+    n_steps = 0
+    reset_peak_memory(device)
+    pop_host_syncs()
+    if sync_debug and device.type == 'cuda':
+        # every device -> host read that bypasses host_item warns
+        torch.cuda.set_sync_debug_mode('warn')
+    accum = GradAccumulator(optimizer,accum_steps)
+    optimizer.zero_grad()
+    with alive_bar(len(epoch_files),title=f"Training epoch {epoch}........ Current Best: {cur_best}") as bar:
+        for fnm,w_imp in zip(epoch_files,weights):
             # input()
             mems = torch.cuda.memory_allocated()
             f_tar = gzip.open(f'{train_tar_dir}/{fnm}','rb')
             to_pack = pickle.load(f_tar)
             v_feats = to_pack['vf'].shape
             c_feats = to_pack['cf'].shape
-            Q = to_pack['Q'].to(device)
-            A = to_pack['A'].to(device)
-            AT = torch.transpose(A,0,1)
+            Q = load_q(to_pack,'Q',device)
+            A = load_a(to_pack,'A',device)
+            AT = A.t()
             c = to_pack['c'].to(device)
             b = to_pack['b'].to(device)
             c = torch.unsqueeze(c,-1)
@@ -1732,9 +2398,9 @@ def train(m,train_files,epoch,train_tar_dir,pareto,device,optimizer,choose_weigh
 
 
 
-            Q_ori = to_pack['Q_ori'].to(device)
-            A_ori = to_pack['A_ori'].to(device)
-            AT_ori = torch.transpose(A_ori,0,1)
+            Q_ori = load_q(to_pack,'Q_ori',device)
+            A_ori = load_a(to_pack,'A_ori',device)
+            AT_ori = A_ori.t()
             c_ori = to_pack['c_ori'].to(device)
             b_ori = to_pack['b_ori'].to(device)
             c_ori = torch.unsqueeze(c_ori,-1)
@@ -1769,161 +2435,200 @@ def train(m,train_files,epoch,train_tar_dir,pareto,device,optimizer,choose_weigh
                 var_lb_ori = var_lb_ori.unsqueeze(-1)
             if var_ub_ori.shape[-1]!=1:
                 var_ub_ori = var_ub_ori.unsqueeze(-1)
+            consts = KKTConstants(Q_ori,b_ori.squeeze(-1),c_ori.squeeze(-1),vscale,cscale,constscale,cons_ident,vars_ident_l,vars_ident_u)
 
             
             # in this version, use all 0 start
             var_feat = torch.zeros((v_feats[0],1),dtype=torch.float32).to(device)
             con_feat = torch.zeros((c_feats[0],1),dtype=torch.float32).to(device)
             
-            print(var_feat.shape[0], con_feat.shape[0])
-            if var_feat.shape[0] > 100000 or con_feat.shape[0] > 100000:
+            if sink is None:
+                print(var_feat.shape[0], con_feat.shape[0])
+            plan = plan_execution(var_feat.shape[0],con_feat.shape[0],sparse_nnz(A)+sparse_nnz(Q),feat,nlayer,budget_mb,
+                                  training=True,device=device,ckpt_segment=cur_ckpt,can_ckpt=can_ckpt)
+            if plan['strategy'] == 'skip':
+                log_skip(fnm,plan['reason'])
+                for i in range(1 if accu_loss else autoregression_iteration):
+                    accum.done()
+                bar()
                 continue
+            if plan['strategy'] != 'plain':
+                print(f'    {fnm}: {plan["strategy"]} execution (ckpt={plan["ckpt"]}, chunk={plan["chunk"]}), ~{round(plan["est_mb"],1)}MB')
+            with apply_plan(m,plan):
             
-            if accu_loss:
-                net_loss = None
-                optimizer.zero_grad()
-            avg_histx = None
-            avg_histy = None
-
-            # input()
-            for itr in range(autoregression_iteration):
-                if not accu_loss:
-                    optimizer.zero_grad()
-                # print(Fore.GREEN + f'{itr} {var_feat.shape}'+Style.RESET_ALL)
-                if avg_histx is not None:
-                    var_feat = avg_histx.detach()
-                    con_feat = avg_histy.detach()
-
-                if not accu_loss:
-                    optimizer.zero_grad()
-                x_pred,y_pred,scs_all,mult,avg_histx,avg_histy = m(AT,A,Q,b,c,var_feat,con_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub,
-                                                        AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori)
-
-                pr = scs_all[1]
-                du = scs_all[2]
-                gp = scs_all[3]
-
-                pr_it = pr.item()
-                du_it = du.item()
-                gp_it = gp.item()
-
-
-
-
-                loss = None
-                # pareto front
-                eps = torch.tensor(1e-6)
-                if pareto:
-                    relkkt1 = scs_all[1]
-                    relkkt2 = scs_all[2]
-                    relkkt3 = scs_all[3]
-                    optimizer.zero_grad()
-                    relkkt1.backward(retain_graph=True)
-                    grd1 = compute_weight_grad(m)
-                    mag_1 = torch.norm(grd1)+eps
-                    optimizer.zero_grad()
-                    relkkt2.backward(retain_graph=True)
-                    grd2 = compute_weight_grad(m)
-                    mag_2 = torch.norm(grd2)+eps
-                    optimizer.zero_grad()
-                    relkkt3.backward(retain_graph=True)
-                    grd3 = compute_weight_grad(m)
-                    mag_3 = torch.norm(grd3)+eps
-                    optimizer.zero_grad()
-
-                    relkkt1 = relkkt1 / mag_1
-                    relkkt2 = relkkt2 / mag_2
-                    relkkt3 = relkkt3 / mag_3
-
-                    loss = relkkt1+relkkt2+relkkt3
+                st_time = time.time()
+                if accu_loss:
+                    net_loss = None
+                avg_histx = None
+                avg_histy = None
 
+                # input()
+                for itr in range(autoregression_iteration):
+                    # gradients are cleared by accum after every optimizer step
+                    # print(Fore.GREEN + f'{itr} {var_feat.shape}'+Style.RESET_ALL)
+                    if avg_histx is not None:
+                        var_feat = avg_histx.detach()
+                        con_feat = avg_histy.detach()
+
+                    x_pred,y_pred,scs_all,mult,avg_histx,avg_histy = m(AT,A,Q,b,c,var_feat,con_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub,
+                                                            AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori,consts=consts)
+                    sample_memory(device)
+
+                    pr = scs_all[1]
+                    du = scs_all[2]
+                    gp = scs_all[3]
+
+                    if sink is None:
+                        pr_it = host_item(pr)
+                        du_it = host_item(du)
+                        gp_it = host_item(gp)
+
+
+
+
+                    loss = None
+                    # pareto front
+                    eps = torch.tensor(1e-6)
+                    if pareto == 'rep':
+                        # balance by the gradient with respect to the predicted x, y
+                        #       instead of three full backward passes over the weights
+                        relkkt1 = scs_all[1]
+                        relkkt2 = scs_all[2]
+                        relkkt3 = scs_all[3]
+                        mag_1,mag_2,mag_3 = compute_objective_grad([relkkt1,relkkt2,relkkt3],[x_pred,y_pred])
+                        loss = relkkt1/(mag_1+eps) + relkkt2/(mag_2+eps) + relkkt3/(mag_3+eps)
+                    elif pareto:
+                        relkkt1 = scs_all[1]
+                        relkkt2 = scs_all[2]
+                        relkkt3 = scs_all[3]
+                        # gradients accumulated from earlier instances are set aside
+                        held = None
+                        if accum.pending > 0:
+                            held = [None if p.grad is None else p.grad.clone() for p in m.parameters()]
+                        optimizer.zero_grad()
+                        relkkt1.backward(retain_graph=True)
+                        grd1 = compute_weight_grad(m)
+                        mag_1 = torch.norm(grd1)+eps
+                        optimizer.zero_grad()
+                        relkkt2.backward(retain_graph=True)
+                        grd2 = compute_weight_grad(m)
+                        mag_2 = torch.norm(grd2)+eps
+                        optimizer.zero_grad()
+                        relkkt3.backward(retain_graph=True)
+                        grd3 = compute_weight_grad(m)
+                        mag_3 = torch.norm(grd3)+eps
+                        optimizer.zero_grad()
+                        if held is not None:
+                            for p,g in zip(m.parameters(),held):
+                                p.grad = g
+
+                        relkkt1 = relkkt1 / mag_1
+                        relkkt2 = relkkt2 / mag_2
+                        relkkt3 = relkkt3 / mag_3
+
+                        loss = relkkt1+relkkt2+relkkt3
 
-                if type(scs_all) == type((1,2)):
-                    scs = scs_all[0]
-                else:
-                    scs = scs_all
 
-                otm = scs.item()
+                    if type(scs_all) == type((1,2)):
+                        scs = scs_all[0]
+                    else:
+                        scs = scs_all
 
-                if not pareto:
-                    loss = scs
+                    if not pareto:
+                        loss = scs
 
-                # loss = pr/pr_it + du/du_it + gp/gp_it
-                # loss = torch.max(pr,torch.max(gp,du))
-                print(Fore.GREEN + f'    {itr} {round(pr_it,4)} {round(du_it,4)} {round(gp_it,4)}  ==>  {otm}'+Style.RESET_ALL)
+                    # loss = pr/pr_it + du/du_it + gp/gp_it
+                    # loss = torch.max(pr,torch.max(gp,du))
+                    if sink is None:
+                        print(Fore.GREEN + f'    {itr} {round(pr_it,4)} {round(du_it,4)} {round(gp_it,4)}  ==>  {host_item(scs)}'+Style.RESET_ALL)
 
-                # loss = (itr*loss)/autoregression_iteration
-                loss_num = scs.item()
-                avg_train_loss[itr] += loss_num
+                    # loss = (itr*loss)/autoregression_iteration
+                    avg_train_loss[itr] += scs.detach()
 
                 
-                if choose_weight:
-                    print(x_pred)
-                    print(x)
-                    print(y_pred)
-                    print(y)
-                    input('wait')
-
-                if accu_loss:
-                    if net_loss is None:
-                        net_loss = loss*((itr+1)/autoregression_iteration)
+                    if choose_weight:
+                        print(x_pred)
+                        print(x)
+                        print(y_pred)
+                        print(y)
+                        input('wait')
+
+                    if accu_loss:
+                        if net_loss is None:
+                            net_loss = loss*((itr+1)/autoregression_iteration)
+                        else:
+                            net_loss = net_loss+loss*((itr+1)/autoregression_iteration)
                     else:
-                        net_loss = net_loss+loss*((itr+1)/autoregression_iteration)
-                else:
-                    loss *=((itr+1)/autoregression_iteration)
-                    loss.backward()
-                    optimizer.step()
+                        loss *=((itr+1)/autoregression_iteration)
+                        accum.backward(loss*w_imp)
 
-                var_feat = x_pred.detach().clone()
-                con_feat = y_pred.detach().clone()
+                    var_feat = x_pred.detach().clone()
+                    con_feat = y_pred.detach().clone()
 
                 
 
-                # print(f'Auto-regression on {fnm}, iteration {itr} loss:{loss_num}')
-            nm=torch.norm(x_pred,float('inf'))
-            # print(f'x linf norm: {nm}')
-            nm=torch.norm(y_pred,float('inf'))
-            # print(f'y linf norm: {nm}')
-            if accu_loss:
-                print(f'{fnm}   avg_loss: {round(net_loss.item()/autoregression_iteration,4)}         {round(pr_it,4)}   ---   {round(du_it,4)}   ---   {round(gp_it,4)}')
-                net_loss.backward()
-                if check_grad:
-                    for name, param in m.named_parameters():
-                        print(param.grad,name)
-                        input()
-                    quit()
-                optimizer.step()
-            else:
-                print(f'{fnm}   avg_loss: {round(loss.item(),4)}        {round(pr_it,4)}   ---   {round(du_it,4)}   ---   {round(gp_it,4)}')
-                # loss.backward()
-                # if check_grad:
-                #     for name, param in m.named_parameters():
-                #         print(param.grad,name)
-                #         input()
-                #     quit()
-                # optimizer.step()
-
-            # print(f'Auto regression finished')
-            # input()
+                    # print(f'Auto-regression on {fnm}, iteration {itr} loss:{loss_num}')
+                nm=torch.norm(x_pred,float('inf'))
+                # print(f'x linf norm: {nm}')
+                nm=torch.norm(y_pred,float('inf'))
+                # print(f'y linf norm: {nm}')
+                if sink is not None:
+                    file_loss = net_loss.detach()/autoregression_iteration if accu_loss else loss.detach()
+                    sink.log({'phase':'train','epoch':epoch,'file':fnm,'loss':file_loss,'relkkt':scs.detach(),'primal':pr.detach(),'dual':du.detach(),'gap':gp.detach()})
+                if accu_loss:
+                    if sink is None:
+                        print(f'{fnm}   avg_loss: {round(host_item(net_loss)/autoregression_iteration,4)}         {round(pr_it,4)}   ---   {round(du_it,4)}   ---   {round(gp_it,4)}')
+                    if check_grad:
+                        net_loss.backward()
+                        for name, param in m.named_parameters():
+                            print(param.grad,name)
+                            input()
+                        quit()
+                    accum.backward(net_loss*w_imp)
+                elif sink is None:
+                    print(f'{fnm}   avg_loss: {round(host_item(loss),4)}        {round(pr_it,4)}   ---   {round(du_it,4)}   ---   {round(gp_it,4)}')
+                    # loss.backward()
+                    # if check_grad:
+                    #     for name, param in m.named_parameters():
+                    #         print(param.grad,name)
+                    #         input()
+                    #     quit()
+                    # optimizer.step()
+
+                # print(f'Auto regression finished')
+                # input()
 
             
-            # try:
-            #     print(compute_weight_grad(m))
-            #     # input('f8i')
-            # except:
-            #     print('no grad')
-            # print('!!!!!!!!!   min/max',torch.min(x_pred).item(),torch.max(x_pred).item())
-
-
-            # f=open('tmp.bounds','w')
-            # for i in range(x_pred.shape[0]):
-            #     if x_pred[i].item()<var_lb[i].item() or x_pred[i].item()>var_ub[i].item():
-            #         st=f'{var_lb[i].item()} {x_pred[i].item()} {var_ub[i].item()}\n'
-            #         f.write(st)
-            # f.close()
+                # try:
+                #     print(compute_weight_grad(m))
+                #     # input('f8i')
+                # except:
+                #     print('no grad')
+                # print('!!!!!!!!!   min/max',torch.min(x_pred).item(),torch.max(x_pred).item())
+
+
+                # f=open('tmp.bounds','w')
+                # for i in range(x_pred.shape[0]):
+                #     if x_pred[i].item()<var_lb[i].item() or x_pred[i].item()>var_ub[i].item():
+                #         st=f'{var_lb[i].item()} {x_pred[i].item()} {var_ub[i].item()}\n'
+                #         f.write(st)
+                # f.close()
+                if sampler is not None:
+                    sampler.update(fnm,scs)
+            sample_memory(device)
+            step_time += time.time()-st_time
+            n_steps += 1
             bar()
+    accum.flush()
+    if sync_debug and device.type == 'cuda':
+        torch.cuda.set_sync_debug_mode('default')
 
-    return avg_train_loss
+    if stats is not None:
+        stats['opt_steps'] = accum.steps
+        stats['step_time'] = step_time/max(n_steps,1)
+        stats['peak_mem'] = peak_memory_mb(device)
+        stats['host_syncs'] = pop_host_syncs()/max(n_steps,1)
+    return [float(v) for v in avg_train_loss]
 
 
 def draw_plot(x=None,y=None,ident=''):
@@ -1964,18 +2669,18 @@ def valid_supervised(m,valid_files,epoch,valid_tar_dir,device,modf,autoregressio
                 to_pack = pickle.load(f_tar)
                 v_feat = to_pack['vf'].to(device)
                 c_feat = to_pack['cf'].to(device)
-                Q = to_pack['Q'].to(device)
-                A = to_pack['A'].to(device)
-                AT = torch.transpose(A,0,1)
+                Q = load_q(to_pack,'Q',device)
+                A = load_a(to_pack,'A',device)
+                AT = A.t()
                 c = to_pack['c'].to(device)
                 b = to_pack['b'].to(device)
                 x = to_pack['x'].to(device)
                 y = to_pack['y'].to(device)
                 c = torch.unsqueeze(c,-1)
                 b = torch.unsqueeze(b,-1)
-                Q_ori = to_pack['Q_ori'].to(device)
-                A_ori = to_pack['A_ori'].to(device)
-                AT_ori = torch.transpose(A_ori,0,1)
+                Q_ori = load_q(to_pack,'Q_ori',device)
+                A_ori = load_a(to_pack,'A_ori',device)
+                AT_ori = A_ori.t()
                 c_ori = to_pack['c_ori'].to(device)
                 b_ori = to_pack['b_ori'].to(device)
                 c_ori = torch.unsqueeze(c_ori,-1)
@@ -2010,6 +2715,7 @@ def valid_supervised(m,valid_files,epoch,valid_tar_dir,device,modf,autoregressio
                     var_lb_ori = var_lb_ori.unsqueeze(-1)
                 if var_ub_ori.shape[-1]!=1:
                     var_ub_ori = var_ub_ori.unsqueeze(-1)
+                consts = KKTConstants(Q_ori,b_ori.squeeze(-1),c_ori.squeeze(-1),vscale,cscale,constscale,cons_ident,vars_ident_l,vars_ident_u)
                     
                     
                 v_feat = torch.zeros((v_feat.shape[0],1),dtype=torch.float32).to(device)
@@ -2023,11 +2729,11 @@ def valid_supervised(m,valid_files,epoch,valid_tar_dir,device,modf,autoregressio
                 for itr in range(autoregression_iteration):
                     # x_pred,y_pred,scs_all,mult = m(AT,A,Q,b,c,v_feat,c_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub)
                     x_pred,y_pred,scs_all,mult,avg_histx,avg_histy = m(AT,A,Q,b,c,v_feat,c_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub,
-                                                    AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori)
+                                                    AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori,consts=consts)
 
                     bqual_ori = b_ori.squeeze(-1).to(device)
                     cqual_ori = c_ori.squeeze(-1).to(device)
-                    ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x_pred,y_pred,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale)
+                    ttloss, prim_res, dual_res, gaps = modf(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x_pred,y_pred,cons_ident,vars_ident_l,vars_ident_u,var_lb_ori,var_ub_ori, vscale,cscale,constscale,consts=consts)
 
                     # ttloss, prim_res, dual_res, gaps = modf(Q,A,AT,bqual,cqual,x_pred,y_pred,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub)
                     print(f'primal_res: {prim_res.item()}   dual_res: {dual_res.item()}   gaps: {gaps.item()}')
@@ -2069,9 +2775,9 @@ def train_supervised(m,train_files,epoch,train_tar_dir,device,optimizer,choose_w
             to_pack = pickle.load(f_tar)
             v_feat = to_pack['vf'].to(device)
             c_feat = to_pack['cf'].to(device)
-            Q = to_pack['Q'].to(device)
-            A = to_pack['A'].to(device)
-            AT = torch.transpose(A,0,1)
+            Q = load_q(to_pack,'Q',device)
+            A = load_a(to_pack,'A',device)
+            AT = A.t()
             c = to_pack['c'].to(device)
             b = to_pack['b'].to(device)
             x = to_pack['x'].to(device)
@@ -2079,9 +2785,9 @@ def train_supervised(m,train_files,epoch,train_tar_dir,device,optimizer,choose_w
             c = torch.unsqueeze(c,-1)
             b = torch.unsqueeze(b,-1)
 
-            Q_ori = to_pack['Q_ori'].to(device)
-            A_ori = to_pack['A_ori'].to(device)
-            AT_ori = torch.transpose(A_ori,0,1)
+            Q_ori = load_q(to_pack,'Q_ori',device)
+            A_ori = load_a(to_pack,'A_ori',device)
+            AT_ori = A_ori.t()
             c_ori = to_pack['c_ori'].to(device)
             b_ori = to_pack['b_ori'].to(device)
             c_ori = torch.unsqueeze(c_ori,-1)
@@ -2116,6 +2822,7 @@ def train_supervised(m,train_files,epoch,train_tar_dir,device,optimizer,choose_w
                 var_lb_ori = var_lb_ori.unsqueeze(-1)
             if var_ub_ori.shape[-1]!=1:
                 var_ub_ori = var_ub_ori.unsqueeze(-1)
+            consts = KKTConstants(Q_ori,b_ori.squeeze(-1),c_ori.squeeze(-1),vscale,cscale,constscale,cons_ident,vars_ident_l,vars_ident_u)
 
             
             # in this version, use all 0 start
@@ -2134,7 +2841,7 @@ def train_supervised(m,train_files,epoch,train_tar_dir,device,optimizer,choose_w
                     optimizer.zero_grad()
                 # x_pred,y_pred,scs_all,mult = m(AT,A,Q,b,c,var_feat,con_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub)
                 x_pred,y_pred,scs_all,mult,avg_histx,avg_histy = m(AT,A,Q,b,c,var_feat,con_feat,cons_ident,vars_ident_l,vars_ident_u,var_lb,var_ub,
-                                                   AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori)
+                                                   AT_ori,A_ori,Q_ori,b_ori,c_ori,vscale,cscale,constscale,var_lb_ori,var_ub_ori,consts=consts)
                 # print(x_pred)
                 pr_it = scs_all[1].item()
                 du_it = scs_all[2].item()
@@ -2207,6 +2914,7 @@ def extract_one(folder_in, folder_out, fnm):
     to_pack['A_ori'] = A_ori.float()
     to_pack['c_ori'] = torch.as_tensor(c_ori).float()
     to_pack['b_ori'] = torch.as_tensor(b_ori).float()
+    to_pack['Q_kind'], to_pack['Q_bw'] = q_structure(Q)
 
     to_pack['x'] = x
     to_pack['y'] = y
@@ -1,6 +1,10 @@
 import torch
 import torch.nn as nn
 import math
+import time
+import random
+import threading
+from torch.utils.checkpoint import checkpoint
 
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -10,15 +14,28 @@ def print_parameters(model):
         print(zz.numel(),zz.names)
         
 def compute_weight_grad(model):
+    # stays on the device, the norms are not read back to the host
     z = []
-    k = 0 
     for a,grad in model.named_parameters():
         if "weight" in a:
             #print(grad.grad)
-            if grad.grad != None:
-                z.append(torch.norm(grad.grad,dim=None).item())
-                k=k+1
-    return torch.tensor(z)
+            if grad.grad is not None:
+                z.append(torch.norm(grad.grad.detach(),dim=None))
+    return torch.stack(z) if len(z) > 0 else torch.zeros(0)
+
+def compute_objective_grad(objs,inputs):
+    # gradient norm of every objective with respect to inputs only, autograd.grad
+    #       walks the graph between the objective and inputs instead of the whole
+    #       network and leaves the .grad of the parameters untouched
+    mags = []
+    for obj in objs:
+        grads = torch.autograd.grad(obj,inputs,retain_graph=True,allow_unused=True)
+        sq = [torch.sum(g*g) for g in grads if g is not None]
+        if len(sq) == 0:
+            mags.append(torch.zeros((),device=obj.device))
+        else:
+            mags.append(torch.sqrt(sum(sq)).detach())
+    return mags
 
         
 def divide_weights(model,div=4.0,div_bias=True):
@@ -40,6 +57,398 @@ def init_weights(m):
         # m.bias.data.fill_(0.001)
 
 
+# number of feature columns per sparse product, 0 multiplies all columns at once
+spmm_chunk = 0
+
+def set_spmm_chunk(chunk):
+    global spmm_chunk
+    spmm_chunk = chunk
+
+# bf16 autocast of the dense layers on cpu, the sparse products and relKKT stay fp32
+dense_bf16 = False
+
+def set_dense_bf16(enabled):
+    global dense_bf16
+    dense_bf16 = enabled
+
+def dense_autocast():
+    return torch.autocast('cpu',dtype=torch.bfloat16,enabled=dense_bf16)
+
+def spmm(A,X):
+    if X.dtype == torch.bfloat16 or torch.is_autocast_enabled('cpu'):
+        with torch.autocast('cpu',enabled=False):
+            return spmm(A,X.float())
+    if isinstance(A,StructuredQ):
+        return A.mm(X)
+    if isinstance(A,SparseOperator):
+        mm = A.mm
+    else:
+        mm = lambda xc: torch.matmul(A,xc)
+    if spmm_chunk <= 0 or X.shape[-1] <= spmm_chunk:
+        return mm(X)
+    return torch.cat([mm(xc) for xc in torch.split(X,spmm_chunk,dim=-1)],-1)
+
+
+# nonzeros gathered at a time by the transposed product
+SPMM_T_BLOCK = 1<<16
+
+# coo / csr / scipy, or auto to benchmark them once per instance shape
+SPMM_BACKENDS = ['coo','csr','scipy']
+spmm_backend = 'csr'
+spmm_tune_feat = 64
+spmm_tuned = {}
+
+def set_spmm_backend(backend,feat=None):
+    global spmm_backend, spmm_tune_feat
+    if backend not in SPMM_BACKENDS and backend != 'auto':
+        raise ValueError(f'unknown spmm backend {backend}, use one of {SPMM_BACKENDS} or auto')
+    spmm_backend = backend
+    if feat is not None:
+        spmm_tune_feat = feat
+
+
+def csr_rows(csr):
+    # row index of every nonzero, expanded from crow_indices
+    crow = csr.crow_indices()
+    return torch.repeat_interleave(torch.arange(csr.shape[0],device=crow.device),crow[1:]-crow[:-1])
+
+
+def csr_mm(csr,X,transposed,rows=None):
+    if not transposed:
+        return torch.sparse.mm(csr,X)
+    # A^T@X scattered straight from the CSR arrays, no transposed copy of A
+    col = csr.col_indices()
+    val = csr.values()
+    if rows is None:
+        rows = csr_rows(csr)
+    res = torch.zeros((csr.shape[1],X.shape[-1]),dtype=X.dtype,device=X.device)
+    for st in range(0,val.shape[0],SPMM_T_BLOCK):
+        ed = st+SPMM_T_BLOCK
+        res.index_add_(0,col[st:ed],val[st:ed].unsqueeze(-1)*X[rows[st:ed]])
+    return res
+
+
+def scipy_mm(mat,X,transposed):
+    if transposed:
+        mat = mat.T
+    return torch.from_numpy(mat @ X.detach().cpu().numpy()).to(X.dtype)
+
+
+class SparseOperatorMM(torch.autograd.Function):
+
+    @staticmethod
+    def forward(ctx,X,op,transposed):
+        ctx.op = op
+        ctx.transposed = transposed
+        return op._mm(X,transposed)
+
+    @staticmethod
+    def backward(ctx,grad):
+        return ctx.op._mm(grad,not ctx.transposed),None,None
+
+
+class SparseOperator():
+    # A stored once in CSR, A.t() shares the storage and runs the transposed kernel
+    #       cache holds the tuned backend and the coo / scipy views it needs
+
+    def __init__(self,csr,transposed=False,cache=None):
+        self.csr = csr
+        self.transposed = transposed
+        self.cache = cache if cache is not None else {}
+        # built once and shared with A.t(), the transposed kernel needs it every call
+        if 'rows' not in self.cache:
+            self.cache['rows'] = csr_rows(csr)
+        if transposed:
+            self.shape = torch.Size((csr.shape[1],csr.shape[0]))
+        else:
+            self.shape = csr.shape
+
+    @staticmethod
+    def from_sparse(A):
+        if A.layout != torch.sparse_csr:
+            if not A.is_sparse:
+                A = A.to_sparse()
+            A = A.coalesce().to_sparse_csr()
+        return SparseOperator(A)
+
+    def t(self):
+        return SparseOperator(self.csr,not self.transposed,self.cache)
+
+    def to(self,device):
+        op = SparseOperator(self.csr.to(device),self.transposed)
+        if 'backend' in self.cache:
+            op.cache['backend'] = self.cache['backend']
+        return op
+
+    def mm(self,X):
+        return SparseOperatorMM.apply(X,self,self.transposed)
+
+    def _nnz(self):
+        return self.csr._nnz()
+
+    def _mm(self,X,transposed):
+        backend = self.cache.get('backend',spmm_backend)
+        if backend == 'coo':
+            if 'coo' not in self.cache:
+                self.cache['coo'] = self.csr.to_sparse_coo().coalesce()
+            coo = self.cache['coo']
+            return torch.sparse.mm(coo.t() if transposed else coo,X)
+        if backend == 'scipy' and X.device.type == 'cpu':
+            if 'scipy' not in self.cache:
+                import scipy.sparse
+                self.cache['scipy'] = scipy.sparse.csr_matrix((self.csr.values().numpy(),self.csr.col_indices().numpy(),
+                                                              self.csr.crow_indices().numpy()),shape=tuple(self.csr.shape))
+            return scipy_mm(self.cache['scipy'],X,transposed)
+        return csr_mm(self.csr,X,transposed,self.cache['rows'])
+
+
+def autotune_spmm(op,feat,repeats=3):
+    device = op.csr.device
+    key = (op.csr.shape[0].bit_length(),op.csr.shape[1].bit_length(),op._nnz().bit_length(),feat,device.type)
+    if key not in spmm_tuned:
+        X = torch.randn((op.csr.shape[1],feat),device=device)
+        Y = torch.randn((op.csr.shape[0],feat),device=device)
+        timing = {}
+        for backend in SPMM_BACKENDS:
+            if backend == 'scipy' and device.type != 'cpu':
+                continue
+            op.cache['backend'] = backend
+            try:
+                op._mm(X,False)
+                op._mm(Y,True)
+            except (RuntimeError, ImportError, NotImplementedError):
+                continue
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            st = time.perf_counter()
+            for _ in range(repeats):
+                op._mm(X,False)
+                op._mm(Y,True)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            timing[backend] = time.perf_counter()-st
+        spmm_tuned[key] = min(timing,key=timing.get)
+        print(f'spmm autotune {tuple(op.csr.shape)} nnz={op._nnz()} feat={feat}: {spmm_tuned[key]}    {timing}')
+    op.cache['backend'] = spmm_tuned[key]
+    for view in ('coo','scipy'):
+        if view != op.cache['backend']:
+            op.cache.pop(view,None)
+    return op
+
+
+def select_backend(op):
+    if spmm_backend == 'auto':
+        autotune_spmm(op,spmm_tune_feat)
+    return op
+
+
+# widest band (|i-j|) still served by the banded kernel instead of a sparse product
+Q_BAND_MAX = 8
+
+def q_structure(Q):
+    # returns (kind, bandwidth) with kind in zero / diag / banded / general
+    if not Q.is_sparse:
+        Q = Q.to_sparse()
+    Q = Q.coalesce()
+    idx = Q.indices()
+    nz = Q.values() != 0
+    if not bool(nz.any()):
+        return 'zero',0
+    bw = int((idx[0]-idx[1])[nz].abs().max())
+    if bw == 0:
+        return 'diag',0
+    if bw <= Q_BAND_MAX:
+        return 'banded',bw
+    return 'general',bw
+
+
+class StructuredQ():
+    # Q stored by its diagonals so that Q@X becomes elementwise work
+    #       bands[o+bw][i] = Q[i,i+o] for o in [-bw,bw]
+
+    def __init__(self,kind,bands,bw,shape,nnz):
+        self.kind = kind
+        self.bands = bands
+        self.bw = bw
+        self.shape = shape
+        self.nnz = nnz
+
+    @staticmethod
+    def from_sparse(Q,kind=None,bw=None):
+        if kind is None:
+            kind,bw = q_structure(Q)
+        if kind == 'general':
+            return Q
+        Q = Q.coalesce()
+        n = Q.shape[0]
+        # stored zeros are ignored as in q_structure, and a kind / bw handed in
+        #       (Q_kind of the scaled Q is also used for Q_ori) is checked against
+        #       this matrix, the general sparse path is kept when it does not fit
+        nz = Q.values() != 0
+        idx = Q.indices()[:,nz]
+        vals = Q.values()[nz]
+        if vals.shape[0] > 0 and (kind == 'zero' or int((idx[1]-idx[0]).abs().max()) > bw):
+            return Q
+        bands = torch.zeros((2*bw+1,n),dtype=Q.dtype,device=Q.device)
+        if kind != 'zero':
+            bands[idx[1]-idx[0]+bw,idx[0]] = vals
+        return StructuredQ(kind,bands,bw,Q.shape,Q._nnz())
+
+    def to(self,device):
+        return StructuredQ(self.kind,self.bands.to(device),self.bw,self.shape,self.nnz)
+
+    def mm(self,X):
+        if self.kind == 'zero':
+            return torch.zeros_like(X)
+        if self.kind == 'diag':
+            return self.bands[0].unsqueeze(-1)*X
+        n = self.shape[0]
+        Xp = torch.nn.functional.pad(X,(0,0,self.bw,self.bw))
+        res = None
+        for o in range(2*self.bw+1):
+            term = self.bands[o].unsqueeze(-1)*Xp[o:o+n]
+            res = term if res is None else res + term
+        return res
+
+    def norm(self,p=2):
+        return torch.linalg.vector_norm(self.bands,p)
+
+
+class KKTConstants():
+    # per-instance quantities of relKKT_general that never change across epochs
+    #       or AR steps, built once at load and passed as consts=
+    #       x_unscaled = x*xscale, y_unscaled = y*yscale
+
+    def __init__(self,Q,b,c,vscale,cscale,constscale,Iy,il,iu):
+        self.Q = Q
+        self.b = b
+        self.c = c
+        self.xscale = torch.div(constscale,vscale)
+        self.yscale = torch.div(constscale,cscale)
+        self.Iy = Iy
+        self.il = il
+        self.iu = iu
+        self.norms = {}
+
+    def norm(self,key,p=2):
+        # norms of b, c and Q, cached per order
+        if (key,p) not in self.norms:
+            with torch.no_grad():
+                if key == 'Q':
+                    self.norms[(key,p)] = self.Q.norm(p)
+                else:
+                    self.norms[(key,p)] = torch.linalg.vector_norm(getattr(self,key),p)
+        return self.norms[(key,p)]
+
+
+def kkt_window(total,fraction):
+    # circular window of round(fraction*total) indices at a uniform random start,
+    #       every index is in it with probability len/total
+    k = min(total,max(1,int(round(fraction*total))))
+    st = random.randrange(total)
+    if st+k <= total:
+        return [(st,st+k)]
+    return [(st,total),(0,st+k-total)]
+
+
+def row_block(M,a,b):
+    # rows a..b of M as a view on its storage, CSR row ranges are contiguous in
+    #       col_indices / values so only crow_indices is rebased
+    if isinstance(M,SparseOperator) and not M.transposed:
+        if 'crow_host' not in M.cache:
+            M.cache['crow_host'] = M.csr.crow_indices().cpu()
+        crow = M.cache['crow_host']
+        s,e = int(crow[a]),int(crow[b])
+        sub = torch.sparse_csr_tensor(M.csr.crow_indices()[a:b+1]-s,M.csr.col_indices()[s:e],M.csr.values()[s:e],
+                                      size=(b-a,M.csr.shape[1]))
+        return SparseOperator(sub,cache={'backend':'csr'})
+    if M.layout == torch.strided:
+        return M[a:b]
+    # coalesced COO is sorted by row
+    M = M.coalesce()
+    idx = M.indices()
+    s,e = torch.searchsorted(idx[0],torch.tensor([a,b],device=idx.device))
+    s,e = host_item(s),host_item(e)
+    sub = idx[:,s:e]-torch.tensor([[a],[0]],device=idx.device)
+    return torch.sparse_coo_tensor(sub,M.values()[s:e],(b-a,M.shape[1])).coalesce()
+
+
+def window_rows(M,X,pieces):
+    # (M@X) on the rows of the window
+    if isinstance(M,StructuredQ):
+        full = spmm(M,X)
+        return torch.cat([full[a:b] for a,b in pieces],0)
+    return torch.cat([spmm(row_block(M,a,b),X) for a,b in pieces],0)
+
+
+def sampled_norm(parts,p):
+    # p-norm of the concatenation of sampled pieces, piece (v,w) was drawn with
+    #       probability 1/w so w*sum|v|^p is unbiased for its share of sum|v|^p
+    #       (the inf-norm uses the sample max and is biased low)
+    norms = [torch.linalg.vector_norm(v,p,dim=0)*(w**(1.0/p)) for v,w in parts]
+    return torch.linalg.vector_norm(torch.stack(norms),p,dim=0)
+
+
+# device -> host reads of the training step (models, loss, AR loop and the console
+#       output of helper.train) go through host_item, so that extra syncs show up in
+#       the per-step stats, sync_debug = 1 in the setting flags any other read on cuda
+host_syncs = 0
+host_syncs_lock = threading.Lock()
+
+def host_item(t):
+    global host_syncs
+    with host_syncs_lock:
+        host_syncs += 1
+    return t.item()
+
+def pop_host_syncs():
+    global host_syncs
+    with host_syncs_lock:
+        n = host_syncs
+        host_syncs = 0
+    return n
+
+def ar_should_stop(sc,threshold,it,check_every=1):
+    # early stop of the AR loop, the residual is only read back every
+    #       check_every steps, 0 never reads it and always runs max_k steps
+    if check_every <= 0 or (it+1) % check_every != 0:
+        return False
+    return host_item(torch.max(sc[0])) <= threshold
+
+
+def unroll_segment(layers,residual_layer,x,x_bar,y,histx,histy,*args):
+    for layer in layers:
+        x,x_bar,y = layer(x,x_bar,y,*args)
+        if histx is None:
+            histx = x
+            histy = y
+        if residual_layer is not None:
+            histx = residual_layer(x, histx)
+            histy = residual_layer(y, histy)
+    return x,x_bar,y,histx,histy
+
+
+def unroll_layers(layers,residual_layer,ckpt_segment,x,x_bar,y,*args,truncate=0,survival=1.0):
+    # ckpt_segment = 0 keeps every activation, k>0 checkpoints every k layers
+    #       and recomputes them in backward
+    # training only: survival < 1 skips layer l with probability (l+1)/L*(1-survival)
+    #       (stochastic depth), truncate = k runs all but the last k layers under no_grad
+    histx = None
+    histy = None
+    if torch.is_grad_enabled() and survival < 1.0:
+        n = len(layers)
+        layers = [layer for i,layer in enumerate(layers) if random.random() < 1.0-(i+1)/n*(1.0-survival)]
+    if torch.is_grad_enabled() and 0 < truncate < len(layers):
+        with torch.no_grad():
+            x,x_bar,y,histx,histy = unroll_segment(layers[:-truncate],residual_layer,x,x_bar,y,histx,histy,*args)
+        layers = layers[-truncate:]
+    if ckpt_segment <= 0 or not torch.is_grad_enabled():
+        return unroll_segment(layers,residual_layer,x,x_bar,y,histx,histy,*args)
+    for st in range(0,len(layers),ckpt_segment):
+        seg = layers[st:st+ckpt_segment]
+        x,x_bar,y,histx,histy = checkpoint(unroll_segment,seg,residual_layer,x,x_bar,y,histx,histy,*args,use_reentrant=False)
+    return x,x_bar,y,histx,histy
+
 
 
 class step_size_pred(torch.nn.Module):
@@ -91,7 +500,7 @@ class inner_loop_geq(torch.nn.Module):
         x_md = (1.0-self.emu_beta)*x_bar + (self.emu_beta)*x
         
         # update x
-        x_new = x - self.emu_eta * (self.lin_3(torch.matmul(Q,x_md)) + cmat - self.lin_4(torch.matmul(AT,y)))
+        x_new = x - self.emu_eta * (self.lin_3(spmm(Q,x_md)) + cmat - self.lin_4(spmm(AT,y)))
         x_new = self.xproj(x_new, indicator_x_l, indicator_x_u, l, u)
 
 
@@ -99,7 +508,7 @@ class inner_loop_geq(torch.nn.Module):
         #       current setting seems better for the theoretical part
         #  !Y update
         x_delta = self.emu_theta*(x_new - x) + x_new
-        x_delta = self.emu_gamma * (bmat - self.lin_1(torch.matmul(A,x_delta))  )
+        x_delta = self.emu_gamma * (bmat - self.lin_1(spmm(A,x_delta))  )
         y_new = y + x_delta
         y_new = self.yproj(y_new, indicator_y)
 
@@ -153,7 +562,7 @@ class inner_loop_geq_morelayer(torch.nn.Module):
         x_md = (1.0-self.emu_beta)*x_bar + (self.emu_beta)*x
         
         # update x
-        x_new = x - self.emu_eta * (self.lin_3(torch.matmul(Q,x_md)) + cmat - self.lin_4(torch.matmul(AT,y)))
+        x_new = x - self.emu_eta * (self.lin_3(spmm(Q,x_md)) + cmat - self.lin_4(spmm(AT,y)))
         x_new = self.xproj(x_new, indicator_x_l, indicator_x_u, l, u)
 
 
@@ -161,7 +570,7 @@ class inner_loop_geq_morelayer(torch.nn.Module):
         #       current setting seems better for the theoretical part
         #  !Y update
         x_delta = self.emu_theta*(x_new - x) + x_new
-        x_delta = self.emu_gamma * (bmat - self.lin_1(torch.matmul(A,x_delta))  )
+        x_delta = self.emu_gamma * (bmat - self.lin_1(spmm(A,x_delta))  )
         y_new = y + x_delta
         y_new = self.yproj(y_new, indicator_y)
 
@@ -205,14 +614,14 @@ class inner_loop_geq_stepsize(torch.nn.Module):
         x_md = (1.0-self.emu_beta)*x_bar + (self.emu_beta)*x
         
         # update x
-        x_new = x - self.emu_eta(x,y) * (self.lin_3(torch.matmul(Q,x_md)) + cmat - self.lin_4(torch.matmul(AT,y)))
+        x_new = x - self.emu_eta(x,y) * (self.lin_3(spmm(Q,x_md)) + cmat - self.lin_4(spmm(AT,y)))
         x_new = self.xproj(x_new, indicator_x_l, indicator_x_u, l, u)
 
         # need to check if we want to wrap this with a linear layer
         #       current setting seems better for the theoretical part
         #  !Y update
         x_delta = self.emu_theta(x_new,y)*(x_new - x) + x_new
-        x_delta = self.emu_gamma(x_new,y) * (bmat - self.lin_1(torch.matmul(A,x_delta))  )
+        x_delta = self.emu_gamma(x_new,y) * (bmat - self.lin_1(spmm(A,x_delta))  )
         y_new = self.yproj(y + x_delta, indicator_y)
 
 
@@ -222,10 +631,13 @@ class inner_loop_geq_stepsize(torch.nn.Module):
 
 
 class PDQP_Net_geq_morelayer(torch.nn.Module):
-    def __init__(self,x_size,y_size,feat_size,nlayer=8, use_residual = None, out_feat = 1):
+    def __init__(self,x_size,y_size,feat_size,nlayer=8, use_residual = None, out_feat = 1, ckpt_segment = 0, truncate = 0, survival = 1.0):
         super(PDQP_Net_geq_morelayer,self).__init__()
 
         self.feat_size = feat_size
+        self.ckpt_segment = ckpt_segment
+        self.truncate = truncate
+        self.survival = survival
 
         self.init_x = nn.Sequential(
             nn.Linear(x_size,feat_size,bias=True),
@@ -278,18 +690,11 @@ class PDQP_Net_geq_morelayer(torch.nn.Module):
         y = self.init_y(y)
         
         x_bar = x
-        histx = None
-        histy = None
         cmat = torch.matmul(c,torch.ones((1,self.feat_size),dtype = torch.float32).to(c.device))
         bmat = torch.matmul(b,torch.ones((1,self.feat_size),dtype = torch.float32).to(b.device))
-        for index, layer in enumerate(self.updates):
-            x,x_bar,y = layer(x,x_bar,y,Q,A,AT,c,b,indicator_y,indicator_x_l,indicator_x_u,l,u,cmat,bmat)
-            if histx is None:
-                histx = x
-                histy = y
-            if self.residual_layer is not None:
-                histx = self.residual_layer(x, histx)
-                histy = self.residual_layer(y, histy)
+        x,x_bar,y,histx,histy = unroll_layers(self.updates,self.residual_layer,self.ckpt_segment,x,x_bar,y,
+                                              Q,A,AT,c,b,indicator_y,indicator_x_l,indicator_x_u,l,u,cmat,bmat,
+                                              truncate=self.truncate if self.training else 0,survival=self.survival if self.training else 1.0)
 
         x = self.out_x(x)
         y = self.out_y(y)
@@ -302,10 +707,13 @@ class PDQP_Net_geq_morelayer(torch.nn.Module):
 
 
 class PDQP_Net_geq(torch.nn.Module):
-    def __init__(self,x_size,y_size,feat_size,nlayer=8, use_residual = None, out_feat = 1):
+    def __init__(self,x_size,y_size,feat_size,nlayer=8, use_residual = None, out_feat = 1, ckpt_segment = 0, truncate = 0, survival = 1.0):
         super(PDQP_Net_geq,self).__init__()
 
         self.feat_size = feat_size
+        self.ckpt_segment = ckpt_segment
+        self.truncate = truncate
+        self.survival = survival
 
         self.init_x = nn.Sequential(
             nn.Linear(x_size,feat_size,bias=True),
@@ -335,6 +743,7 @@ class PDQP_Net_geq(torch.nn.Module):
         #     nn.Linear(feat_size,1,bias=False),
         # )
         self.residual_layer = None
+        self.res_finalx = None
         if use_residual is not None:
             # self.residual_layer = None
             self.residual_layer = RestartLayer(feat_size,feat_size,feat_size)
@@ -348,18 +757,11 @@ class PDQP_Net_geq(torch.nn.Module):
         # y = self.init(y)
         
         x_bar = x
-        histx = None
-        histy = None
         cmat = torch.matmul(c,torch.ones((1,self.feat_size),dtype = torch.float32).to(c.device))
         bmat = torch.matmul(b,torch.ones((1,self.feat_size),dtype = torch.float32).to(b.device))
-        for index, layer in enumerate(self.updates):
-            x,x_bar,y = layer(x,x_bar,y,Q,A,AT,c,b,indicator_y,indicator_x_l,indicator_x_u,l,u,cmat,bmat)
-            if histx is None:
-                histx = x
-                histy = y
-            if self.residual_layer is not None:
-                histx = self.residual_layer(x, histx)
-                histy = self.residual_layer(y, histy)
+        x,x_bar,y,histx,histy = unroll_layers(self.updates,self.residual_layer,self.ckpt_segment,x,x_bar,y,
+                                              Q,A,AT,c,b,indicator_y,indicator_x_l,indicator_x_u,l,u,cmat,bmat,
+                                              truncate=self.truncate if self.training else 0,survival=self.survival if self.training else 1.0)
         x = self.out_x(x)
         y = self.out_y(y)
         # x = self.out(x)
@@ -372,17 +774,21 @@ class PDQP_Net_geq(torch.nn.Module):
 
 class PDQP_Net_AR_geq(torch.nn.Module):
     def __init__(self,x_size,y_size,feat_size,max_k = 20, threshold = 1e-8,nlayer=1, 
-                 tfype='linf', use_dual=True, eta_opt = 1e+6, div=4.0, mode=None, use_residual=None, out_feat = 1, summation=False, norm = False):
+                 tfype='linf', use_dual=True, eta_opt = 1e+6, div=4.0, mode=None, use_residual=None, out_feat = 1, summation=False, norm = False,
+                 ckpt_segment = 0, check_every = 1, truncate = 0, survival = 1.0):
         super(PDQP_Net_AR_geq,self).__init__()
         self.max_k = max_k
         self.threshold = threshold
+        self.check_every = check_every
         self.use_residual = use_residual
         
         if mode is not None:
             print('USING MORE LINEAR LAYERS!!!!!!')
-            self.net = PDQP_Net_geq_morelayer(x_size,y_size,feat_size,nlayer=nlayer, use_residual = self.use_residual, out_feat = out_feat)
+            self.net = PDQP_Net_geq_morelayer(x_size,y_size,feat_size,nlayer=nlayer, use_residual = self.use_residual, out_feat = out_feat, ckpt_segment = ckpt_segment,
+                                              truncate = truncate, survival = survival)
         else:
-            self.net = PDQP_Net_geq(x_size,y_size,feat_size,nlayer=nlayer, use_residual = self.use_residual, out_feat = out_feat)
+            self.net = PDQP_Net_geq(x_size,y_size,feat_size,nlayer=nlayer, use_residual = self.use_residual, out_feat = out_feat, ckpt_segment = ckpt_segment,
+                                    truncate = truncate, survival = survival)
         self.net.apply(init_weights)
         divide_weights(self.net,div=div,div_bias=True)
 
@@ -391,7 +797,8 @@ class PDQP_Net_AR_geq(torch.nn.Module):
         # self.final_out = proj_x_no_mlp(1)
 
     def forward(self,AT,A,Q,b,c,x,y,indicator_y,indicator_x_l,indicator_x_u,l,u,
-                                AT_ori=None,A_ori=None,Q_ori=None,b_ori=None,c_ori=None,vscale=None,cscale=None,constscale=None,var_lb_ori=None,var_ub_ori=None):
+                                AT_ori=None,A_ori=None,Q_ori=None,b_ori=None,c_ori=None,vscale=None,cscale=None,constscale=None,var_lb_ori=None,var_ub_ori=None,
+                                consts=None):
         bqual_ori = b_ori.squeeze(-1)
         cqual_ori = c_ori.squeeze(-1)
 
@@ -402,13 +809,19 @@ class PDQP_Net_AR_geq(torch.nn.Module):
         residualy = None
 
         for iter in range(self.max_k):
-            x,y,residualx, residualy = self.net(A,AT,Q,b,c,x,y,indicator_y,indicator_x_l,indicator_x_u,l,u)
+            with dense_autocast():
+                x,y,residualx, residualy = self.net(A,AT,Q,b,c,x,y,indicator_y,indicator_x_l,indicator_x_u,l,u)
+            x = x.float()
+            y = y.float()
+            if residualx is not None:
+                residualx = residualx.float()
+                residualy = residualy.float()
             # x = self.final_out(x, indicator_x_l, indicator_x_u, l, u)
             sc = self.qual_func(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x,y,indicator_y,indicator_x_l,indicator_x_u,var_lb_ori,var_ub_ori,
-                                vscale,cscale,constscale)
+                                vscale,cscale,constscale,consts=consts)
 
             scs = sc
-            if sc[0].item() <= self.threshold:
+            if ar_should_stop(sc,self.threshold,iter,self.check_every):
                 break
         else:   
             mult = 1.0
@@ -468,7 +881,7 @@ class PDQP_Net(torch.nn.Module):
     def forward(self,A,Q,b,c,x,y):
         c = torch.unsqueeze(c,-1)
         b = torch.unsqueeze(b,-1)
-        AT = torch.transpose(A,0,1)
+        AT = A.t()
         x_bar = x
         y_bar = y
         x_hist = [x,x]
@@ -591,13 +1004,13 @@ class inner_loop_restart(torch.nn.Module):
         #       current setting seems better for the theoretical part
         x_delta = self.emu_theta*(x - x_past) + x
 
-        x_delta = self.emu_gamma * self.lin_1(torch.matmul(A,x_delta))
+        x_delta = self.emu_gamma * self.lin_1(spmm(A,x_delta))
         # y_new = self.proj_pos(y + x_delta - b)
         # print('GHGGG', y.shape,x_delta.shape, b.shape)
         y_new = y + x_delta - b
 
 
-        x_new = x - self.emu_eta * (self.lin_2(torch.matmul(Q,x_md)) + c + self.lin_3(torch.matmul(AT,y))) 
+        x_new = x - self.emu_eta * (self.lin_2(spmm(Q,x_md)) + c + self.lin_3(spmm(AT,y))) 
 
         # relu to emulate proj to l<x<u, looks weird but aligns exactly
         x_new = self.shift_x3(self.shift_x1(x_new) - self.shift_x2(x_new))
@@ -662,10 +1075,11 @@ class PDQP_Net_new(torch.nn.Module):
 
 
 class PDQP_Net_AR(torch.nn.Module):
-    def __init__(self,x_size,y_size,feat_size,max_k = 20, threshold = 1e-8,nlayer=1, type='linf', use_dual=True):
+    def __init__(self,x_size,y_size,feat_size,max_k = 20, threshold = 1e-8,nlayer=1, type='linf', use_dual=True, check_every = 1):
         super(PDQP_Net_AR,self).__init__()
         self.max_k = max_k
         self.threshold = threshold
+        self.check_every = check_every
         
         self.net = PDQP_Net_new(x_size,y_size,feat_size,nlayer=nlayer)
         self.net.apply(init_weights)
@@ -707,7 +1121,7 @@ class PDQP_Net_AR(torch.nn.Module):
             # else:
             #     scs += sc
             scs = sc
-            if sc[0].item() <= self.threshold:
+            if ar_should_stop(sc,self.threshold,iter,self.check_every):
                 break
         else:   
             mult = 1.0
@@ -802,12 +1216,12 @@ class inner_loop_shared(torch.nn.Module):
         #       current setting seems better for the theoretical part
         #  !Y update
         x_delta = self.emu_theta*(x - x_past) + x
-        x_delta = self.emu_gamma * self.lin(torch.matmul(A,x_delta))
+        x_delta = self.emu_gamma * self.lin(spmm(A,x_delta))
         y_new = self.yproj(y + x_delta - bmat, indicator_y)
 
 
         #  !X update
-        x_new = self.lin(x) - self.emu_eta * (self.lin(torch.matmul(Q,x_md)) + cmat + self.lin(torch.matmul(AT,y))) 
+        x_new = self.lin(x) - self.emu_eta * (self.lin(spmm(Q,x_md)) + cmat + self.lin(spmm(AT,y))) 
         x_new = self.xproj(x_new, indicator_x_l, indicator_x_u, l, u)
 
         x_bar = (1.0-self.emu_beta)*x_bar + self.emu_beta*x_new
@@ -815,11 +1229,57 @@ class inner_loop_shared(torch.nn.Module):
         return x_new,x_bar,y_new
         
         
+def deq_solve(f,z,max_iter,tol):
+    # fixed-point iteration z = f(z) without a graph, stops on the relative step size
+    k = 0
+    with torch.no_grad():
+        for k in range(max_iter):
+            z_next = f(z)
+            diff = torch.linalg.vector_norm(z_next-z)/(torch.linalg.vector_norm(z)+1e-12)
+            z = z_next
+            if host_item(diff) < tol:
+                break
+    return z, k+1
+
+
+def deq_attach(f,z_star,bwd_iter,bwd_tol):
+    # one differentiable application of f at the fixed point, the hook on its
+    #       output replaces the incoming gradient by the solution of
+    #       g = J^T g + grad (implicit function theorem), so backward holds two
+    #       applications of f whatever the number of forward iterations
+    z = f(z_star)
+    if not z.requires_grad:
+        return z
+    z0 = z_star.detach().requires_grad_()
+    f0 = f(z0)
+
+    def hook(grad):
+        g = grad
+        for _ in range(bwd_iter):
+            g_next = torch.autograd.grad(f0,z0,g,retain_graph=True)[0] + grad
+            diff = torch.linalg.vector_norm(g_next-g)/(torch.linalg.vector_norm(g_next)+1e-12)
+            g = g_next
+            if host_item(diff) < bwd_tol:
+                break
+        return g
+    z.register_hook(hook)
+    return z
+
+
 class PDQP_Net_shared(torch.nn.Module):
-    def __init__(self,x_size,y_size,feat_size,max_k = 20, threshold = 1e-4,nlayer=1,type='l2'):
+    # deq: max_k is the cap of fixed-point iterations of the shared layer, trained
+    #       by implicit differentiation instead of backpropagating through them
+    def __init__(self,x_size,y_size,feat_size,max_k = 20, threshold = 1e-4,nlayer=1,type='l2', check_every = 1,
+                 deq = False, deq_tol = 1e-5, deq_bwd_iter = 30, deq_bwd_tol = 1e-6):
         super(PDQP_Net_shared,self).__init__()
         self.max_k = max_k
         self.threshold = threshold
+        self.check_every = check_every
+        self.deq = deq
+        self.deq_tol = deq_tol
+        self.deq_bwd_iter = deq_bwd_iter
+        self.deq_bwd_tol = deq_bwd_tol
+        self.deq_iters = 0
         
         self.net = PDQP_layer_shared(x_size,y_size,feat_size,nlayer=nlayer)
         self.net.apply(init_weights)
@@ -835,11 +1295,18 @@ class PDQP_Net_shared(torch.nn.Module):
         #     self.qual_func = relKKT_l1()
         # if type=='linf':  
         #     self.qual_func = relKKT()
-        self.qual_func = relKKT_general(tfype)
+        self.qual_func = relKKT_general(type)
 
-    def forward(self,AT,A,Q,b,c,x,y,indicator_y,indicator_x_l,indicator_x_u,l,u):
-        bqual = b.squeeze(-1)
-        cqual = c.squeeze(-1)
+    def forward(self,AT,A,Q,b,c,x,y,indicator_y,indicator_x_l,indicator_x_u,l,u,
+                                AT_ori=None,A_ori=None,Q_ori=None,b_ori=None,c_ori=None,vscale=None,cscale=None,constscale=None,var_lb_ori=None,var_ub_ori=None,
+                                consts=None):
+        # without the unscaled problem the residual is taken on the scaled one
+        full = AT_ori is not None
+        if not full:
+            AT_ori,A_ori,Q_ori,b_ori,c_ori,var_lb_ori,var_ub_ori = AT,A,Q,b,c,l,u
+            vscale = cscale = constscale = torch.ones(1,device=b.device)
+        bqual = b_ori.squeeze(-1)
+        cqual = c_ori.squeeze(-1)
         
         # if debug:
         #     print(f'Problem size: {A.shape}')
@@ -849,25 +1316,43 @@ class PDQP_Net_shared(torch.nn.Module):
         # l_hist = []
         scs = None
         mult = 0.0
-        for iter in range(self.max_k):
-            x,y = self.net(A,AT,Q,b,c,x,y,indicator_y,indicator_x_l,indicator_x_u,l,u)
-            x_hist.append(x)
-            y_hist.append(y)
-            sc = self.qual_func(Q,A,AT,bqual,cqual,x,y,indicator_y,indicator_x_l,indicator_x_u,l,u)
-            # l_hist.append(sc)
-            # if scs is None:
-            #     scs = sc
-            # else:
-            #     scs += sc
-            scs = sc
-            if sc[0].item() <= self.threshold:
-                break
+        if self.deq:
+            n = x.shape[0]
+            def f(z):
+                xs,ys = self.net(A,AT,Q,b,c,z[:n],z[n:],indicator_y,indicator_x_l,indicator_x_u,l,u)
+                return torch.cat((xs,ys),0)
+            z,self.deq_iters = deq_solve(f,torch.cat((x,y),0),self.max_k,self.deq_tol)
+            if torch.is_grad_enabled():
+                z = deq_attach(f,z,self.deq_bwd_iter,self.deq_bwd_tol)
+            x = z[:n]
+            y = z[n:]
+            scs = self.qual_func(Q_ori,A_ori,AT_ori,bqual,cqual,x,y,indicator_y,indicator_x_l,indicator_x_u,var_lb_ori,var_ub_ori,
+                                 vscale,cscale,constscale,consts=consts)
+            if self.deq_iters >= self.max_k:
+                mult = 1.0
         else:
-            mult = 1.0
+            for iter in range(self.max_k):
+                x,y = self.net(A,AT,Q,b,c,x,y,indicator_y,indicator_x_l,indicator_x_u,l,u)
+                x_hist.append(x)
+                y_hist.append(y)
+                sc = self.qual_func(Q_ori,A_ori,AT_ori,bqual,cqual,x,y,indicator_y,indicator_x_l,indicator_x_u,var_lb_ori,var_ub_ori,
+                                    vscale,cscale,constscale,consts=consts)
+                # l_hist.append(sc)
+                # if scs is None:
+                #     scs = sc
+                # else:
+                #     scs += sc
+                scs = sc
+                if ar_should_stop(sc,self.threshold,iter,self.check_every):
+                    break
+            else:
+                mult = 1.0
 
             
 
-
+        if full:
+            # same outputs as PDQP_Net_AR_geq for helper.train / valid
+            return x,y,scs,mult,None,None
         return x,y,scs,mult
         # return x,y,l_hist,mult
 
@@ -1012,12 +1497,12 @@ class inner_loop_new(torch.nn.Module):
         #       current setting seems better for the theoretical part
         #  !Y update
         x_delta = self.emu_theta*(x - x_past) + x
-        x_delta = self.emu_gamma * self.lin_1(torch.matmul(A,x_delta))
+        x_delta = self.emu_gamma * self.lin_1(spmm(A,x_delta))
         y_new = self.yproj(y + x_delta - bmat, indicator_y)
 
 
         #  !X update
-        x_new = self.lin_2(x) - self.emu_eta * (self.lin_3(torch.matmul(Q,x_md)) + cmat + self.lin_4(torch.matmul(AT,y))) 
+        x_new = self.lin_2(x) - self.emu_eta * (self.lin_3(spmm(Q,x_md)) + cmat + self.lin_4(spmm(AT,y))) 
         x_new = self.xproj(x_new, indicator_x_l, indicator_x_u, l, u)
 
         x_bar = (1.0-self.emu_beta)*x_bar + self.emu_beta*x_new
@@ -1105,13 +1590,13 @@ class inner_loop(torch.nn.Module):
         # need to check if we want to wrap this with a linear layer
         #       current setting seems better for the theoretical part
         x_delta = self.emu_theta*(x - x_past) + x
-        x_delta = self.emu_gamma * self.lin_1(torch.matmul(A,x_delta))
+        x_delta = self.emu_gamma * self.lin_1(spmm(A,x_delta))
         # y_new = self.proj_pos(y + x_delta - b)
         y_new = y + x_delta - b 
         y_new = self.shift_y(y_new)
 
 
-        x_new = x - self.emu_eta * (self.lin_2(torch.matmul(Q,x_md)) + c + self.lin_3(torch.matmul(AT,y)) )
+        x_new = x - self.emu_eta * (self.lin_2(spmm(Q,x_md)) + c + self.lin_3(spmm(AT,y)) )
 
         # relu to emulate proj to l<x<u, looks weird but aligns exactly
         x_new = self.shift_x(x_new)
@@ -1130,7 +1615,7 @@ class r_primal(torch.nn.Module):
         self.relu = nn.ReLU()
         
     def forward(self,A,b,c,x,Iy, il, iu, l, u):
-        Ax = torch.sparse.mm(A,x)
+        Ax = spmm(A,x)
         # lower_variable_violation[tx] = max(variable_lower_bound[tx] - primal_vec[tx], 0.0)
         # upper_variable_violation[tx] = max(primal_vec[tx] - variable_upper_bound[tx], 0.0)
         #     constraint_violation[tx] = right_hand_side[tx] - activities[tx]
@@ -1158,7 +1643,7 @@ class r_primal_old(torch.nn.Module):
         # self.act = nn.ReLU()
         
     def forward(self,A,b,c,x,Iy):
-        Ax = torch.sparse.mm(A,x)
+        Ax = spmm(A,x)
         part_2 = torch.linalg.vector_norm(self.act(Ax-b.unsqueeze(-1),Iy),float('inf'))
         
         # part_3 = 1.0 + torch.max(torch.linalg.vector_norm(part_1,float('inf')),torch.linalg.vector_norm(b,float('inf')))
@@ -1173,8 +1658,8 @@ class r_dual(torch.nn.Module):
         self.yproj = proj_y(1)
         
     def forward(self,Q,AT,b,c,x,y,Iy, il, iu, l, u):
-        Qx = torch.sparse.mm(Q,x) 
-        ATy = torch.sparse.mm(AT,y) 
+        Qx = spmm(Q,x) 
+        ATy = spmm(AT,y) 
         
         primal_grad = Qx + ATy + c.unsqueeze(-1)
         
@@ -1206,8 +1691,8 @@ class r_dual_inf_pdqp(torch.nn.Module):
         # print(x[0])
         # print(y[0])
 
-        Qx = torch.sparse.mm(Q,x) 
-        ATy = torch.sparse.mm(AT,y) 
+        Qx = spmm(Q,x) 
+        ATy = spmm(AT,y) 
         
         primal_grad = c.unsqueeze(-1) + ATy + Qx
         
@@ -1239,14 +1724,14 @@ class r_gap(torch.nn.Module):
     def forward(self,Q,A,AT,b,c,x,y, il, iu, l, u):
         
         xt = torch.transpose(x,0,1)
-        qx = torch.matmul(Q,x)
+        qx = spmm(Q,x)
         quad_term = torch.matmul(xt,qx)
         # print(c.shape,x.shape)
         lin_term = torch.matmul(c,x)
         vio_term = torch.matmul(b,y)
 
         # compute RC
-        ATy = torch.sparse.mm(AT,y) 
+        ATy = spmm(AT,y) 
         primal_grad = c.unsqueeze(-1) - ATy + qx
         
         RC = torch.mul(self.act(primal_grad), il) + torch.mul(-self.act(-primal_grad), iu)
@@ -1345,7 +1830,7 @@ class r_primal_l1(torch.nn.Module):
         self.act = proj_y(1)
         
     def forward(self,A,b,c,x,Iy):
-        part_1 = torch.sparse.mm(A,x)-b.unsqueeze(-1)
+        part_1 = spmm(A,x)-b.unsqueeze(-1)
         part_1 = self.act(part_1,Iy)
         part_1 = torch.linalg.vector_norm(part_1,1)
         part_3 = 1.0 + torch.linalg.vector_norm(b,1)
@@ -1357,8 +1842,8 @@ class r_dual_l1(torch.nn.Module):
         super(r_dual_l1,self).__init__()
         
     def forward(self,Q,AT,b,c,x,y):
-        Qx = torch.sparse.mm(Q,x) 
-        ATy = torch.sparse.mm(AT,y) 
+        Qx = spmm(Q,x) 
+        ATy = spmm(AT,y) 
         
         
         top_part = torch.linalg.vector_norm(Qx + ATy + c.unsqueeze(-1),1)
@@ -1375,7 +1860,7 @@ class r_gap_l1(torch.nn.Module):
     def forward(self,Q,A,AT,b,c,x,y):
         
         xt = torch.transpose(x,0,1)
-        qx = torch.matmul(Q,x)
+        qx = spmm(Q,x)
         quad_term = torch.matmul(xt,qx)
         lin_term = torch.matmul(c,x)
         vio_term = torch.matmul(b,y)
@@ -1425,7 +1910,7 @@ class r_primal_real(torch.nn.Module):
         self.act = nn.ReLU()
         
     def forward(self,A,b,c,x,Iy, il, iu, l, u):
-        Ax = torch.sparse.mm(A,x)
+        Ax = spmm(A,x)
         var_vio = torch.mul(self.act(l-x), il) + torch.mul(self.act(x-u), iu)
         cons_vio = b.unsqueeze(-1) - Ax
         cons_vio = cons_vio + torch.mul(self.act(-cons_vio),Iy)
@@ -1442,8 +1927,8 @@ class r_dual_inf_real(torch.nn.Module):
         
     def forward(self,Q,AT,b,c,x,y,Iy, il, iu, l, u):
 
-        Qx = torch.sparse.mm(Q,x) 
-        ATy = torch.sparse.mm(AT,y) 
+        Qx = spmm(Q,x) 
+        ATy = spmm(AT,y) 
         
         primal_grad = c.unsqueeze(-1) - ATy + Qx
         
@@ -1466,10 +1951,14 @@ class relKKT_real(torch.nn.Module):
 
     # def forward(self,Q,A,AT,b,c,x,y,Iy, il, iu, l, u):
 
-    def forward(self,Q,A,AT,b,c,x,y,Iy, il, iu, l, u, vscale,cscale,cons_scale):
+    def forward(self,Q,A,AT,b,c,x,y,Iy, il, iu, l, u, vscale,cscale,cons_scale, consts=None):
         
-        x_unscaled = torch.mm(torch.div(x,vscale),cons_scale)
-        y_unscaled = torch.mm(torch.div(y,cscale),cons_scale)
+        if consts is None:
+            x_unscaled = torch.mm(torch.div(x,vscale),cons_scale)
+            y_unscaled = torch.mm(torch.div(y,cscale),cons_scale)
+        else:
+            x_unscaled = x*consts.xscale
+            y_unscaled = y*consts.yscale
 
         t1 = self.rpm(A,b,c,x_unscaled,Iy, il, iu, l, u)
         t2 = self.rdl(Q,AT,b,c,x_unscaled,y_unscaled,Iy, il, iu, l, u)
@@ -1508,15 +1997,20 @@ class r_primal_general(torch.nn.Module):
         #         input()
         # input()
 
-        Ax = torch.sparse.mm(A,x)
+        Ax = spmm(A,x)
+        return self.from_products(Ax,b,x,Iy, il, iu, l, u)
+
+    def from_products(self,Ax,b,x,Iy, il, iu, l, u, b_norm=None):
         cons_vio = b.unsqueeze(-1) - Ax
         cons_vio = cons_vio + torch.mul(self.relu(-cons_vio),Iy)
         var_vio = torch.mul(self.relu(l-x), il) + torch.mul(self.relu(x-u), iu)
-        part_2 = torch.linalg.vector_norm(torch.cat((var_vio,cons_vio),0),self.mode)
+        part_2 = torch.linalg.vector_norm(torch.cat((var_vio,cons_vio),0),self.mode,dim=0)
+        if b_norm is None:
+            b_norm = torch.linalg.vector_norm(b,self.mode)
         if self.norm:
-            part_3 = 1.0 + torch.max(torch.linalg.vector_norm(Ax,self.mode),torch.linalg.vector_norm(b,self.mode)).item()
+            part_3 = 1.0 + torch.max(torch.linalg.vector_norm(Ax,self.mode,dim=0),b_norm).detach()
         else:
-            part_3 = 1.0 + torch.linalg.vector_norm(b,self.mode)
+            part_3 = 1.0 + b_norm
             # part_3 = 1.0 
         res = part_2/part_3
         # print(f'var_vio: {torch.norm(var_vio,2).item()}   cons_vio: {torch.norm(cons_vio,2).item()}')
@@ -1534,25 +2028,27 @@ class r_dual_general(torch.nn.Module):
         
     def forward(self,Q,AT,b,c,x,y,Iy, il, iu, l, u):
 
-        Qx = torch.sparse.mm(Q,x) 
-        ATy = torch.sparse.mm(AT,y) 
-        
+        Qx = spmm(Q,x) 
+        ATy = spmm(AT,y) 
+        return self.from_products(Qx,ATy,c,y,Iy, il, iu)
 
-        primal_grad = c.unsqueeze(-1) - ATy + Qx
+    def from_products(self,Qx,ATy,c,y,Iy, il, iu, primal_grad=None, c_norm=None, c_norm2=None):
+        if primal_grad is None:
+            primal_grad = c.unsqueeze(-1) - ATy + Qx
         
         RCV = primal_grad - torch.mul(self.act(primal_grad), il) - torch.mul(-self.act(-primal_grad), iu)
         DR = torch.mul(self.act(-y), Iy)
-        
-        RCV_norm= torch.norm(RCV,self.mode)
-        DR_norm= torch.norm(DR,self.mode)
-        # print(f'RCV norm: {RCV_norm}     DR norm: {DR_norm}')
 
-        top_part = torch.linalg.vector_norm(torch.cat((RCV, DR),0),self.mode)
+        top_part = torch.linalg.vector_norm(torch.cat((RCV, DR),0),self.mode,dim=0)
         
         if self.norm:
-            bot_part = 1.0 + torch.max(torch.linalg.vector_norm(Qx,self.mode),torch.max(torch.linalg.vector_norm(ATy,self.mode),torch.linalg.vector_norm(c,2))).item()
+            if c_norm2 is None:
+                c_norm2 = torch.linalg.vector_norm(c,2)
+            bot_part = 1.0 + torch.max(torch.linalg.vector_norm(Qx,self.mode,dim=0),torch.max(torch.linalg.vector_norm(ATy,self.mode,dim=0),c_norm2)).detach()
         else:
-            bot_part = 1.0 + torch.linalg.vector_norm(c,self.mode)
+            if c_norm is None:
+                c_norm = torch.linalg.vector_norm(c,self.mode)
+            bot_part = 1.0 + c_norm
             # bot_part = 1.0 
         res = top_part/bot_part
         return res
@@ -1572,15 +2068,19 @@ class r_gap_general(torch.nn.Module):
         
         
     def forward(self,Q,A,AT,b,c,x,y,Iy, il, iu,l,u):
-        xt = torch.transpose(x,0,1)
-        qx = torch.matmul(Q,x)
-        quad_term = torch.matmul(xt,qx)
+        qx = spmm(Q,x)
+        ATy = spmm(AT,y) 
+        return self.from_products(Q,qx,ATy,b,c,x,y, il, iu,l,u)
+
+    def from_products(self,Q,qx,ATy,b,c,x,y, il, iu,l,u, primal_grad=None, consts=None):
+        # one entry per candidate column of x and y
+        quad_term = torch.sum(torch.mul(x,qx),0)
         lin_term = torch.matmul(c,x)
         vio_term = torch.matmul(b,y)
         
         # compute RC
-        ATy = torch.sparse.mm(AT,y) 
-        primal_grad = c.unsqueeze(-1) - ATy + qx
+        if primal_grad is None:
+            primal_grad = c.unsqueeze(-1) - ATy + qx
         
         
         RC = torch.mul(self.act(primal_grad), il) + torch.mul(-self.act(-primal_grad), iu)
@@ -1590,7 +2090,7 @@ class r_gap_general(torch.nn.Module):
         #         print(rc_contribution[i].item(),RC[i].item(),l[i].item(),u[i].item())
         # quit()
         rc_contribution = torch.mul(RC,rc_contribution)
-        rc_contribution = torch.sum(rc_contribution)
+        rc_contribution = torch.sum(rc_contribution,0)
         # rc_contribution = torch.norm(rc_contribution,1)
         
 
@@ -1632,9 +2132,12 @@ class r_gap_general(torch.nn.Module):
         # bot_part = 1.0 + torch.max(torch.abs(vio_term - 0.5*quad_term ),torch.abs(0.5*quad_term + lin_term))
         bot_part = self.eta_opt
         if self.eta_opt is None:
-            bot_part = 1.0 + torch.max(torch.abs(vio_term - 0.5*quad_term ),torch.abs(0.5*quad_term + lin_term)).item()
+            bot_part = 1.0 + torch.max(torch.abs(vio_term - 0.5*quad_term ),torch.abs(0.5*quad_term + lin_term)).detach()
         elif self.eta_opt < 0:
-            bot_part = 1.0 + torch.linalg.vector_norm(c,self.mode) + torch.linalg.vector_norm(b,self.mode) + torch.norm(Q,self.mode)
+            if consts is not None:
+                bot_part = 1.0 + consts.norm('c',self.mode) + consts.norm('b',self.mode) + consts.norm('Q',self.mode)
+            else:
+                bot_part = 1.0 + torch.linalg.vector_norm(c,self.mode) + torch.linalg.vector_norm(b,self.mode) + Q.norm(self.mode)
         # bot_part = 1.0 + torch.max(torch.abs(vio_term - 0.5*quad_term ),torch.abs(0.5*quad_term + lin_term)).item()
         # bot_part = 1.0 + torch.max(torch.abs(vio_term - 0.5*quad_term ),torch.abs(0.5*quad_term + lin_term))
         
@@ -1653,7 +2156,7 @@ class r_CS(torch.nn.Module):
         self.eta_opt = eta_opt
     def forward(self,Q,A,AT,b,c,x,y,Iy, il, iu,l,u):
         # consider ocnstraint violation
-        Axb = torch.mul(y,torch.sparse.mm(A,x)- b.unsqueeze(-1))
+        Axb = torch.mul(y,spmm(A,x)- b.unsqueeze(-1))
         Axb = torch.mul(Axb,Iy)
         Axb = torch.norm(Axb,1)
         return (Axb)/self.eta_opt
@@ -1671,12 +2174,12 @@ class r_CS_general(torch.nn.Module):
         
     def forward(self,Q,A,AT,b,c,x,y,Iy, il, iu,l,u):
         # consider ocnstraint violation
-        Axb = torch.mul(y,torch.sparse.mm(A,x)- b.unsqueeze(-1))
+        Axb = torch.mul(y,spmm(A,x)- b.unsqueeze(-1))
         Axb = torch.mul(Axb,Iy)
         Axb = torch.norm(Axb,1)
         # consider bound violations
-        ATy = torch.sparse.mm(AT,y) 
-        qx = torch.matmul(Q,x)
+        ATy = spmm(AT,y) 
+        qx = spmm(Q,x)
         primal_grad = c.unsqueeze(-1) - ATy + qx
 
 
@@ -1728,20 +2231,40 @@ class relKKT_general(torch.nn.Module):
         self.summation = summation
         
 
-    def forward(self,Q,A,AT,b,c,x,y,Iy, il, iu, l, u, vscale,cscale,cons_scale):
+    def forward(self,Q,A,AT,b,c,x,y,Iy, il, iu, l, u, vscale,cscale,cons_scale, consts=None):
         
         # # Unscale iterates. 
         # x = x./variable_rescaling
         # x = x.*const_scale
 
-        x_unscaled = torch.mm(torch.div(x,vscale),cons_scale)
-        y_unscaled = torch.mm(torch.div(y,cscale),cons_scale)
-
+        b_norm = None
+        c_norm = None
+        c_norm2 = None
+        # x and y may carry a trailing candidate dimension, (n,K) and (m,K),
+        #       every term then returns one residual per candidate
+        x = x.float()
+        y = y.float()
+        if consts is None:
+            x_unscaled = torch.mul(torch.div(x,vscale),cons_scale)
+            y_unscaled = torch.mul(torch.div(y,cscale),cons_scale)
+        else:
+            # scales and norms precomputed at load, see KKTConstants
+            x_unscaled = x*consts.xscale
+            y_unscaled = y*consts.yscale
+            Iy, il, iu = consts.Iy, consts.il, consts.iu
+            b_norm = consts.norm('b',self.rpm.mode)
+            c_norm = consts.norm('c',self.rdl.mode)
+            c_norm2 = consts.norm('c',2)
+
+        # Ax, A^Ty and Qx are shared by the three terms, computed once here
+        Ax = spmm(A,x_unscaled)
+        ATy = spmm(AT,y_unscaled)
+        Qx = spmm(Q,x_unscaled)
+        primal_grad = c.unsqueeze(-1) - ATy + Qx
 
-
-        t1 = self.rpm(A,b,c,x_unscaled,Iy, il, iu, l, u)
-        t2 = self.rdl(Q,AT,b,c,x_unscaled,y_unscaled,Iy, il, iu, l, u)
-        t3 =self.rgp(Q,A,AT,b,c,x_unscaled,y_unscaled,Iy, il, iu,l,u)
+        t1 = self.rpm.from_products(Ax,b,x_unscaled,Iy, il, iu, l, u, b_norm)
+        t2 = self.rdl.from_products(Qx,ATy,c,y_unscaled,Iy, il, iu, primal_grad, c_norm, c_norm2)
+        t3 = self.rgp.from_products(Q,Qx,ATy,b,c,x_unscaled,y_unscaled, il, iu,l,u, primal_grad, consts)
 
         res = None
         if self.summation:
@@ -1761,6 +2284,87 @@ class relKKT_general(torch.nn.Module):
     
 
 
+class relKKT_sampled(relKKT_general):
+    # estimate of relKKT_general from one random window of constraints and one of
+    #       variables per call, a full evaluation every full_every calls
+    #       Ax and Qx are taken on row slices of the CSR / COO storage of A and Q,
+    #       A^Ty is a full product (CSR has no column slices) indexed afterwards
+
+    def __init__(self,mode=2,eta_opt = 1e+6,norm=False,summation=False,fraction=0.1,full_every=10):
+        super(relKKT_sampled,self).__init__(mode,eta_opt,norm,summation)
+        self.fraction = fraction
+        self.full_every = full_every
+        self.step = 0
+
+    def forward(self,Q,A,AT,b,c,x,y,Iy, il, iu, l, u, vscale,cscale,cons_scale, consts=None):
+        # validation and prediction (no grad or eval mode) get the full relKKT and
+        #       do not advance the full_every schedule of training
+        if not torch.is_grad_enabled() or not self.training:
+            return super(relKKT_sampled,self).forward(Q,A,AT,b,c,x,y,Iy, il, iu, l, u, vscale,cscale,cons_scale, consts=consts)
+        self.step += 1
+        if consts is None or self.fraction >= 1.0 or (self.full_every > 0 and self.step % self.full_every == 0):
+            return super(relKKT_sampled,self).forward(Q,A,AT,b,c,x,y,Iy, il, iu, l, u, vscale,cscale,cons_scale, consts=consts)
+        m,n = A.shape
+        rwin = kkt_window(m,self.fraction)
+        cwin = kkt_window(n,self.fraction)
+        device = x.device
+        rows = torch.cat([torch.arange(a,b,device=device) for a,b in rwin])
+        cols = torch.cat([torch.arange(a,b,device=device) for a,b in cwin])
+        wr = m/rows.shape[0]
+        wc = n/cols.shape[0]
+        relu = self.rpm.relu
+        p = self.rpm.mode
+
+        x_unscaled = x.float()*consts.xscale
+        y_unscaled = y.float()*consts.yscale
+        Iy, il, iu = consts.Iy, consts.il, consts.iu
+
+        # primal: sampled constraints, sampled variable bounds
+        Ax = window_rows(A,x_unscaled,rwin)
+        cons_vio = b[rows].unsqueeze(-1) - Ax
+        cons_vio = cons_vio + torch.mul(relu(-cons_vio),Iy[rows])
+        xs = x_unscaled[cols]
+        var_vio = torch.mul(relu(l[cols]-xs), il[cols]) + torch.mul(relu(xs-u[cols]), iu[cols])
+        t1 = sampled_norm([(cons_vio,wr),(var_vio,wc)],p)
+        if self.rpm.norm:
+            t1 = t1/(1.0 + torch.max(sampled_norm([(Ax,wr)],p),consts.norm('b',p)).detach())
+        else:
+            t1 = t1/(1.0 + consts.norm('b',p))
+
+        # dual: reduced costs of the sampled variables, full dual sign violation
+        ATy = spmm(AT,y_unscaled)[cols]
+        Qx = window_rows(Q,x_unscaled,cwin)
+        primal_grad = c[cols].unsqueeze(-1) - ATy + Qx
+        RCV = primal_grad - torch.mul(relu(primal_grad), il[cols]) - torch.mul(-relu(-primal_grad), iu[cols])
+        DR = torch.mul(relu(-y_unscaled), Iy)
+        t2 = sampled_norm([(RCV,wc),(DR,1.0)],p)
+        if self.rdl.norm:
+            t2 = t2/(1.0 + torch.max(sampled_norm([(Qx,wc)],p),torch.max(sampled_norm([(ATy,wc)],p),consts.norm('c',2))).detach())
+        else:
+            t2 = t2/(1.0 + consts.norm('c',p))
+
+        # gap: x^TQx and the reduced cost term from the sampled variables
+        quad_term = wc*torch.sum(torch.mul(xs,Qx),0)
+        lin_term = torch.matmul(c,x_unscaled)
+        vio_term = torch.matmul(b,y_unscaled)
+        RC = torch.mul(relu(primal_grad), il[cols]) + torch.mul(-relu(-primal_grad), iu[cols])
+        rc_contribution = wc*torch.sum(torch.mul(RC,torch.where(RC>0,l[cols],u[cols])),0)
+        t3 = torch.abs(quad_term + lin_term - vio_term - rc_contribution)
+        eta_opt = self.rgp.eta_opt
+        if eta_opt is None:
+            t3 = t3/(1.0 + torch.max(torch.abs(vio_term - 0.5*quad_term ),torch.abs(0.5*quad_term + lin_term)).detach())
+        elif eta_opt < 0:
+            t3 = t3/(1.0 + consts.norm('c',p) + consts.norm('b',p) + consts.norm('Q',p))
+        else:
+            t3 = t3/eta_opt
+
+        if self.summation:
+            res = t1+t2+t3
+        else:
+            res = torch.max(t3,torch.max(t2,t1))
+        return res,t1,t2,t3
+
+
 class GNN_AR_geq(torch.nn.Module):
     def __init__(self,x_size,y_size,feat_size,max_k = 20, threshold = 1e-8,nlayer=1, 
                  tfype='linf', use_dual=True, eta_opt = 1e+6, div=4.0, summation=False, norm = False):
@@ -1816,7 +2420,8 @@ class GNN_AR_geq(torch.nn.Module):
         self.apply(init_weights)
 
     def forward(self,AT,A,Q,b,c,x,y,indicator_y,indicator_x_l,indicator_x_u,l,u,
-                                AT_ori=None,A_ori=None,Q_ori=None,b_ori=None,c_ori=None,vscale=None,cscale=None,constscale=None,var_lb_ori=None,var_ub_ori=None):
+                                AT_ori=None,A_ori=None,Q_ori=None,b_ori=None,c_ori=None,vscale=None,cscale=None,constscale=None,var_lb_ori=None,var_ub_ori=None,
+                                consts=None):
         bqual = b.squeeze(-1)
         cqual = c.squeeze(-1)
         bqual_ori = b_ori.squeeze(-1)
@@ -1830,26 +2435,29 @@ class GNN_AR_geq(torch.nn.Module):
             indicator_y = indicator_y.unsqueeze(-1)
         y = torch.cat((b,indicator_y,y),1)
         
-        x = self.x_emb(x)
-        y = self.y_emb(y)
+        with dense_autocast():
+            x = self.x_emb(x)
+            y = self.y_emb(y)
 
-        # y = self.vtoc(y,x,Q,AT,A,c,b)
-        # x = self.ctov(x,y,Q,A,AT,c,b)
+            # y = self.vtoc(y,x,Q,AT,A,c,b)
+            # x = self.ctov(x,y,Q,A,AT,c,b)
 
 
-        for index, layer in enumerate(self.c_updates):
-            y = self.c_updates[index](y,x,Q,AT,A,c,b)
-            x = self.v_updates[index](x,y,Q,A,AT,c,b)
-        
-        x = self.output_module(x)
-        y = self.output_module_y(y)
+            for index, layer in enumerate(self.c_updates):
+                y = self.c_updates[index](y,x,Q,AT,A,c,b)
+                x = self.v_updates[index](x,y,Q,A,AT,c,b)
+            
+            x = self.output_module(x)
+            y = self.output_module_y(y)
+        x = x.float()
+        y = y.float()
         
 
         scs = None
         mult = 0.0
         
         sc = self.qual_func(Q_ori,A_ori,AT_ori,bqual_ori,cqual_ori,x,y,indicator_y,indicator_x_l,indicator_x_u,var_lb_ori,var_ub_ori,
-                            vscale,cscale,constscale)
+                            vscale,cscale,constscale,consts=consts)
         scs = sc
 
         return x,y,scs,mult,x,y
@@ -1892,7 +2500,7 @@ class GNN_layer(torch.nn.Module):
         # X+AYW
         x = self.feature_module_left(x)
         y = self.feature_module_left(y)
-        joint_feature = self.feature_module_final(x+torch.matmul(AT,y))
+        joint_feature = self.feature_module_final(x+spmm(AT,y))
         res = self.output_module(torch.cat((joint_feature,prev),1))
         
 
@@ -1939,8 +2547,8 @@ class GNN_layer_withQ(torch.nn.Module):
         # X+AYW
         x = self.feature_module_left(x)
         y = self.feature_module_left(y)
-        joint_feature = self.feature_module_final(x+torch.matmul(AT,y))
-        joint_feature_Q = self.feature_module_finalQ(x+torch.matmul(Q,x))
+        joint_feature = self.feature_module_final(x+spmm(AT,y))
+        joint_feature_Q = self.feature_module_finalQ(x+spmm(Q,x))
         res = self.output_module(torch.cat((joint_feature,joint_feature_Q,prev),1))
         
 
@@ -37,6 +37,33 @@ if int(config['accum_loss'])==0:
     accum_loss = False
 
 
+# independent instances of validation / prediction on inst_workers threads, each
+#       capped at inst_threads intra-op threads (0 splits the cores between them)
+inst_workers = 1
+if 'inst_workers' in config:
+    inst_workers = int(config['inst_workers'])
+inst_threads = 0
+if 'inst_threads' in config:
+    inst_threads = int(config['inst_threads'])
+if inst_workers > 1 and inst_threads == 0:
+    inst_threads = max(1,os.cpu_count()//inst_workers)
+
+# bf16 autocast of the dense layers on cpu (sparse products and relKKT stay fp32)
+use_bf16 = False
+if 'bf16' in config:
+    use_bf16 = int(config['bf16']) == 1
+set_dense_bf16(use_bf16)
+
+use_deq = False
+if 'deq' in config:
+    use_deq = int(config['deq']) == 1
+deq_iter = 50
+if 'deq_iter' in config:
+    deq_iter = int(config['deq_iter'])
+deq_tol = 1e-5
+if 'deq_tol' in config:
+    deq_tol = float(config['deq_tol'])
+
 inf_time = max_k
 if 'inf_time' in config:
     inf_time = int(config['inf_time'])
@@ -67,7 +94,9 @@ if max_k > 1:
     use_residual = max_k
 
 if model_mode == 0:
-    m = PDQP_Net_shared(1,1,net_width,max_k = 1, threshold = 1e-8,nlayer=nlayer,type='linf').to(device)
+    m = PDQP_Net_shared(1,1,net_width,max_k = deq_iter if use_deq else 1, threshold = 1e-8,nlayer=nlayer,type='linf',deq = use_deq, deq_tol = deq_tol).to(device)
+    if use_deq:
+        ident += f'_deq{deq_iter}'
 elif model_mode == 1:
     m = PDQP_Net_AR(1,1,net_width,max_k = 1, threshold = 1e-8,nlayer=nlayer,type='linf',use_dual=use_dual).to(device)
     ident += '_AR'
@@ -206,9 +235,8 @@ with torch.no_grad():
 
 
     with alive_bar(len(test_files),title=f"Validating part") as bar:
-        for fnm in test_files:
-            inference(m,fnm,last_epoch,test_tar_dir,pareto,device,modf,inf_time)
-            bar()
+        map_instances(lambda fnm,defer: inference(m,fnm,last_epoch,test_tar_dir,pareto,device,modf,inf_time,defer=defer),
+                      test_files,inst_workers,inst_threads,bar)
 
         
 
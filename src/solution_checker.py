@@ -1,27 +1,44 @@
 from model import *
 from helper import *
 import torch
+import os
+import json
 import matplotlib.pyplot as plt
 plt.rcParams.update({'font.size': 16})
-device = torch.device(f"cuda:1" if torch.cuda.is_available() else "cpu")
 
-modf = relKKT_general(mode = '2',norm=True)
-# tar = '/home/lxyang/git/pdqpnet/pkl/8906_valid/QPLIB_8906_17.mps.pkl'
-tar = '/home/lxyang/git/pdqpnet/pkl/8845_valid/QPLIB_8845_6.mps.pkl'
-tar = '/home/lxyang/git/pdqpnet/pkl/3547_train/QPLIB_3547_143.mps.pkl'
-# tar = '/home/lxyang/git/pdqpnet/pkl/8559_valid/QPLIB_8559_17.mps.pkl'
-# tar = '/home/lxyang/git/pdqpnet/pkl/3913_valid/QPLIB_3913_256.mps.pkl'
-# tar = '/home/lxyang/git/pdqpnet/pkl/8906_valid/QPLIB_8906_459.mps.pkl'
+# residual vs distance to z* under random multiplicative perturbations of the
+#       stored solution, the sample is loaded once and the perturbations are
+#       scored in batches of candidate columns
 
+import argparse
+parser = argparse.ArgumentParser(description='Perturbation study of relKKT around the stored solution.')
+parser.add_argument('--tar', type=str, default='../pkl/3547_train/QPLIB_3547_143.mps.pkl')
+parser.add_argument('--npert','-n', type=int, default=400)
+parser.add_argument('--scale', type=float, default=1.0, help='magnitudes drawn as scale*N(0,1)')
+parser.add_argument('--mags', type=str, default='', help='comma separated magnitudes, each used npert times instead of random ones')
+parser.add_argument('--chunk', type=int, default=64)
+parser.add_argument('--mode', type=str, default='2')
+parser.add_argument('--norm', type=int, default=1)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--out','-o', type=str, default='../plots/distance')
+parser.add_argument('--gpu', type=int, default=-1)
+args = parser.parse_args()
 
-perts=torch.randn(size=(400,))
-# perts=perts+[.1]*50
-# perts=perts+[.2]*50
-# perts=perts+[.3]*50
-# perts=[.0001,.001,.01,.1,.2,.3,.4]
+device = torch.device(f"cuda:{args.gpu}" if args.gpu >= 0 and torch.cuda.is_available() else "cpu")
+torch.manual_seed(args.seed)
+
+modf = relKKT_general(mode = args.mode,norm=args.norm==1)
+inst = load_kkt_instance(args.tar,device)
+ori_x = inst['x'] if inst['x'].dim() == 2 else inst['x'].unsqueeze(-1)
+ori_y = inst['y'] if inst['y'].dim() == 2 else inst['y'].unsqueeze(-1)
+
+if args.mags != '':
+    perts = torch.tensor([float(v) for v in args.mags.split(',')]).repeat_interleave(args.npert)
+else:
+    perts = torch.randn(size=(args.npert,))*args.scale
+# the unperturbed solution goes first
+perts = torch.cat((torch.zeros(1),perts)).to(device)
 
-records = []
-z = torch.tensor(0.0)
 x_norm = []
 y_norm = []
 norms = []
@@ -30,81 +47,62 @@ press = []
 dress = []
 total_loss = []
 
-ori_x,ori_y,sc,pres,dres,gap = sol_check(tar,device,modf)
-records.append([sc,pres,dres,gap,z,z])
-x_norm.append(z.item())
-y_norm.append(z.item())
-norms.append(z.item())
-gaps.append(gap.item())
-press.append(pres.item())
-dress.append(dres.item())
-total_loss.append(sc.item())
-
-print(ori_x)
+with torch.no_grad():
+    for st in range(0,perts.shape[0],args.chunk):
+        p = perts[st:st+args.chunk]
+        # same law as sol_check: every entry scaled by 1+U(-p,p)
+        x = ori_x*(1.0+(torch.rand((ori_x.shape[0],p.shape[0]),device=device)*2.0-1.0)*p)
+        y = ori_y*(1.0+(torch.rand((ori_y.shape[0],p.shape[0]),device=device)*2.0-1.0)*p)
+        sc,pres,dres,gap = kkt_eval(inst,modf,x,y)
+        norm1 = torch.linalg.vector_norm(x-ori_x,2,dim=0)/torch.norm(ori_x,2)
+        norm2 = torch.linalg.vector_norm(y-ori_y,2,dim=0)/torch.norm(ori_y,2)
+        x_norm += norm1.tolist()
+        y_norm += norm2.tolist()
+        norms += (norm1+norm2).tolist()
+        gaps += gap.tolist()
+        press += pres.tolist()
+        dress += dres.tolist()
+        total_loss += sc.tolist()
 
-for p in perts:
-    x,y,sc,pres,dres,gap = sol_check(tar,device,modf,p)
-    norm1 = torch.norm(x-ori_x,2)/torch.norm(ori_x,2)
-    norm2 = torch.norm(y-ori_y,2)/torch.norm(ori_y,2)
-    records.append([sc,pres,dres,gap,norm1,norm2])
-    x_norm.append(norm1.item())
-    y_norm.append(norm2.item())
-    norms.append((norm1+norm2).item())
-    gaps.append(gap.item())
-    press.append(pres.item())
-    dress.append(dres.item())
-    total_loss.append(sc.item())
+print(f'unperturbed: relKKT {total_loss[0]}   primal {press[0]}   dual {dress[0]}   gap {gaps[0]}')
+print(f'{len(total_loss)-1} perturbations, relKKT min {min(total_loss[1:])} max {max(total_loss[1:])}')
 
-
-
-for i in range(len(records)):
-    print(round(records[i][0].item(),4),end='  ')
-print()
-for i in range(len(records)):
-    print(round(records[i][1].item(),4),end='  ')
-print()
-for i in range(len(records)):
-    print(round(records[i][2].item(),4),end='  ')
-print()
-for i in range(len(records)):
-    print(round(records[i][3].item(),4),end='  ')
-print('\n------------------------------------------------')
-for i in range(len(records)):
-    print(round(records[i][-1].item(),4),end='  ')
-print()
-for i in range(len(records)):
-    print(round(records[i][-2].item(),4),end='  ')
-print()
+os.makedirs(args.out,exist_ok=True)
+f = open(f'{args.out}/records.jsonl','w')
+for i in range(len(total_loss)):
+    f.write(json.dumps({'pert':perts[i].item(),'x_dist':x_norm[i],'y_dist':y_norm[i],'relkkt':total_loss[i],
+                        'primal':press[i],'dual':dress[i],'gap':gaps[i]})+'\n')
+f.close()
 
 
 plt.scatter(norms,total_loss)
 # plt.xscale('log')
 plt.xlabel('Distance to z*')
 plt.ylabel('Total Residual')
-plt.savefig('../plots/distance/totalloss.png', bbox_inches='tight')
-plt.savefig('../plots/distance/totalloss.pdf', format="pdf", bbox_inches="tight")
+plt.savefig(f'{args.out}/totalloss.png', bbox_inches='tight')
+plt.savefig(f'{args.out}/totalloss.pdf', format="pdf", bbox_inches="tight")
 plt.clf()
 
 plt.scatter(x_norm,press)
 # plt.xscale('log')
 plt.xlabel('Distance to z*')
 plt.ylabel('Primal Residual')
-plt.savefig('../plots/distance/pres.png', bbox_inches='tight')
-plt.savefig('../plots/distance/pres.pdf', format="pdf", bbox_inches="tight")
+plt.savefig(f'{args.out}/pres.png', bbox_inches='tight')
+plt.savefig(f'{args.out}/pres.pdf', format="pdf", bbox_inches="tight")
 plt.clf()
 
 plt.scatter(y_norm,dress)
 # plt.xscale('log')
 plt.xlabel('Distance to z*')
 plt.ylabel('Dual Residual')
-plt.savefig('../plots/distance/dres.png', bbox_inches='tight')
-plt.savefig('../plots/distance/dres.pdf', format="pdf", bbox_inches="tight")
+plt.savefig(f'{args.out}/dres.png', bbox_inches='tight')
+plt.savefig(f'{args.out}/dres.pdf', format="pdf", bbox_inches="tight")
 plt.clf()
 
 plt.scatter(norms,gaps)
 plt.yscale('log')
 plt.xlabel('Distance to z*')
 plt.ylabel('Primal-dual Gap')
-plt.savefig('../plots/distance/gao.png', bbox_inches='tight')
-plt.savefig('../plots/distance/gao.pdf', format="pdf", bbox_inches="tight")
-plt.clf()
\ No newline at end of file
+plt.savefig(f'{args.out}/gao.png', bbox_inches='tight')
+plt.savefig(f'{args.out}/gao.pdf', format="pdf", bbox_inches="tight")
+plt.clf()
@@ -0,0 +1,93 @@
+import os
+import sys
+import csv
+import json
+import time
+import itertools
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# runs train_new.py for several setting sections, or for a grid over keys of one
+#       section, as concurrent processes with a thread cap each, e.g.
+#       python sweep.py -s twod,8547 -j 2
+#       python sweep.py -t twod -g "nlayer=2,4;lr=1e-5,1e-6" -j 4 -m 50
+# every job gets its own extraid so models and logs of the grid do not collide
+
+import argparse
+parser = argparse.ArgumentParser(description='Concurrent sweep of train_new.py runs.')
+parser.add_argument('--sections','-s', type=str, default='', help='comma separated setting sections')
+parser.add_argument('--type','-t', type=str, default='', help='base section of the grid')
+parser.add_argument('--grid','-g', type=str, default='', help='key=v1,v2;key2=v3,v4 over the base section')
+parser.add_argument('--jobs','-j', type=int, default=2, help='concurrent runs')
+parser.add_argument('--threads', type=int, default=0, help='threads per run, 0 splits the cores between the runs')
+parser.add_argument('--maxepoch','-m', type=int, default=100)
+parser.add_argument('--out','-o', type=str, default='../logs/sweep/results.csv')
+args = parser.parse_args()
+
+FIELDS = ['job','section','overrides','best_relkkt','relkkt','primal','dual','gap','valid_loss','epoch','time_to_target','step_time','wall_time','returncode']
+
+
+def make_jobs():
+    jobs = []
+    for sec in [v for v in args.sections.split(',') if v != '']:
+        jobs.append((sec,{}))
+    if args.grid != '':
+        keys = []
+        values = []
+        for part in args.grid.split(';'):
+            k,v = part.split('=',1)
+            keys.append(k.strip())
+            values.append([x.strip() for x in v.split(',')])
+        for combo in itertools.product(*values):
+            jobs.append((args.type,dict(zip(keys,combo))))
+    return jobs
+
+
+def run_job(i,sec,overrides,threads,outdir):
+    name = f'{i}_{sec}'+''.join(f'_{k}{v}' for k,v in overrides.items())
+    res_file = f'{outdir}/{name}.json'
+    sets = dict(overrides)
+    sets['threads'] = threads
+    sets['extraid'] = f'sweep{i}_'
+    cmd = [sys.executable,'train_new.py','-t',sec,'-m',str(args.maxepoch),'--result',res_file]
+    for k,v in sets.items():
+        cmd += ['--set',f'{k}={v}']
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = str(threads)
+    env['MKL_NUM_THREADS'] = str(threads)
+    st = time.time()
+    with open(f'{outdir}/{name}.out','w') as fout:
+        proc = subprocess.run(cmd,stdout=fout,stderr=subprocess.STDOUT,env=env)
+    row = {'job':name,'section':sec,'overrides':';'.join(f'{k}={v}' for k,v in overrides.items()),
+           'wall_time':time.time()-st,'returncode':proc.returncode}
+    if os.path.exists(res_file):
+        with open(res_file) as f:
+            res = json.load(f)
+        for k in FIELDS:
+            if k in res and k != 'wall_time':
+                row[k] = res[k]
+    print(f'{name}: rc {proc.returncode}   relKKT {row.get("relkkt","-")}   best {row.get("best_relkkt","-")}   {round(row["wall_time"],1)}s')
+    return row
+
+
+if __name__ == '__main__':
+    jobs = make_jobs()
+    if len(jobs) == 0:
+        parser.error('give --sections or --type with --grid')
+    njobs = max(1,min(args.jobs,len(jobs)))
+    threads = args.threads if args.threads > 0 else max(1,os.cpu_count()//njobs)
+    outdir = os.path.dirname(os.path.abspath(args.out))
+    os.makedirs(outdir,exist_ok=True)
+    print(f'{len(jobs)} runs, {njobs} at a time with {threads} threads each')
+
+    with ThreadPoolExecutor(njobs) as pool:
+        futures = [pool.submit(run_job,i,sec,ov,threads,outdir) for i,(sec,ov) in enumerate(jobs)]
+        rows = [fu.result() for fu in futures]
+
+    f = open(args.out,'w')
+    w = csv.DictWriter(f,fieldnames=FIELDS)
+    w.writeheader()
+    for row in rows:
+        w.writerow(row)
+    f.close()
+    print(f'results written to {args.out}')
@@ -5,6 +5,9 @@ import gzip
 import os
 from alive_progress import alive_bar
 import random 
+import time
+import json
+import torch.distributed as dist
 
 # torch.backends.cudnn.enabled=False
 
@@ -13,6 +16,8 @@ parser = argparse.ArgumentParser(description='Process some integers.')
 parser.add_argument('--type','-t', type=str, default='')
 parser.add_argument('--sl','-s', type=int, default=0)
 parser.add_argument('--maxepoch','-m', type=int, default=100000)
+parser.add_argument('--set', type=str, action='append', default=[], help='key=value overriding the setting section, repeatable')
+parser.add_argument('--result', type=str, default='', help='json file receiving the final validation relKKT and wall time')
 
 args = parser.parse_args()
 
@@ -31,6 +36,9 @@ pareto = True
 
 
 config = getConfig(args.type)
+for kv in args.set:
+    k,v = kv.split('=',1)
+    config[k.strip()] = v.strip()
 max_k = int(config['max_k'])
 nlayer = int(config['nlayer'])
 lr1 = float(config['lr'])
@@ -68,12 +76,167 @@ div = 1.0
 if 'div' in config:
     div = float(config['div'])
 
+# activation checkpointing: 0 off, k recomputes every k unrolled layers in backward
+ckpt_segment = 0
+if 'ckpt' in config:
+    ckpt_segment = int(config['ckpt'])
+
+# AR early stop: read the residual back every k steps, 0 never (always max_k steps)
+ar_check = 1
+if 'ar_check' in config:
+    ar_check = int(config['ar_check'])
+# warn on every cuda sync of the training step that is not counted in host syncs/step
+sync_debug = False
+if 'sync_debug' in config:
+    sync_debug = int(config['sync_debug']) == 1
+
+# sampled relKKT training loss: fraction of rows/columns per step, full evaluation every N steps
+kkt_sample = 1.0
+if 'kkt_sample' in config:
+    kkt_sample = float(config['kkt_sample'])
+kkt_full_every = 10
+if 'kkt_full_every' in config:
+    kkt_full_every = int(config['kkt_full_every'])
+
+# per-file metrics go to ../logs/metrics_{ident}.jsonl (or .csv), flushed every metrics_interval seconds
+metrics_interval = 5.0
+if 'metrics_interval' in config:
+    metrics_interval = float(config['metrics_interval'])
+metrics_format = 'jsonl'
+if 'metrics_format' in config:
+    metrics_format = config['metrics_format']
+
+# data parallel training over gloo, launched with torchrun, e.g.
+#       torchrun --nproc_per_node=4 train_new.py -t <section>
+world_size = int(os.environ.get('WORLD_SIZE','1'))
+rank = int(os.environ.get('RANK','0'))
+if world_size > 1:
+    dist.init_process_group('gloo')
+    print(f'rank {rank}/{world_size}')
+
+# periodic checkpoints every ckpt_every epochs (0 off), the newest ckpt_keep are kept
+ckpt_every = 0
+if 'ckpt_every' in config:
+    ckpt_every = int(config['ckpt_every'])
+ckpt_keep = 3
+if 'ckpt_keep' in config:
+    ckpt_keep = int(config['ckpt_keep'])
+
+# validation every valid_every epochs on a valid_subsample fraction of the files,
+#       async_valid = 1 runs it on a cpu worker process while training continues
+valid_every = 1
+if 'valid_every' in config:
+    valid_every = int(config['valid_every'])
+valid_subsample = 1.0
+if 'valid_subsample' in config:
+    valid_subsample = float(config['valid_subsample'])
+async_valid = False
+if 'async_valid' in config:
+    async_valid = int(config['async_valid']) == 1
+valid_threads = max(1,os.cpu_count()//4)
+if 'valid_threads' in config:
+    valid_threads = int(config['valid_threads'])
+
+# sampler = priority draws the training files by their running relKKT
+#       (priority_alpha, priority_beta), target_relkkt logs the time to reach it
+use_priority = 'sampler' in config and config['sampler'] == 'priority'
+priority_alpha = 1.0
+if 'priority_alpha' in config:
+    priority_alpha = float(config['priority_alpha'])
+priority_beta = 0.5
+if 'priority_beta' in config:
+    priority_beta = float(config['priority_beta'])
+target_relkkt = None
+if 'target_relkkt' in config:
+    target_relkkt = float(config['target_relkkt'])
+
+# model_mode 0 as a deep equilibrium model: up to deq_iter iterations of the shared
+#       layer, gradients by an implicit solve of deq_bwd_iter fixed-point steps
+use_deq = False
+if 'deq' in config:
+    use_deq = int(config['deq']) == 1
+deq_iter = 50
+if 'deq_iter' in config:
+    deq_iter = int(config['deq_iter'])
+deq_tol = 1e-5
+if 'deq_tol' in config:
+    deq_tol = float(config['deq_tol'])
+deq_bwd_iter = 30
+if 'deq_bwd_iter' in config:
+    deq_bwd_iter = int(config['deq_bwd_iter'])
+
+# cheaper steps for deep unrolls (model_mode 2/3, training only): backprop through the
+#       last truncate_k layers, or keep layer l with probability 1-(l+1)/L*(1-survival)
+truncate_k = 0
+if 'truncate_k' in config:
+    truncate_k = int(config['truncate_k'])
+survival = 1.0
+if 'survival' in config:
+    survival = float(config['survival'])
+
+# independent instances of validation / prediction on inst_workers threads, each
+#       capped at inst_threads intra-op threads (0 splits the cores between them)
+inst_workers = 1
+if 'inst_workers' in config:
+    inst_workers = int(config['inst_workers'])
+inst_threads = 0
+if 'inst_threads' in config:
+    inst_threads = int(config['inst_threads'])
+if inst_workers > 1 and inst_threads == 0:
+    inst_threads = max(1,os.cpu_count()//inst_workers)
+
+# curriculum = 1 trains on the smallest curriculum_start fraction of the instances
+#       (nnz of A and Q) first and admits all of them by epoch curriculum_epochs
+use_curriculum = False
+if 'curriculum' in config:
+    use_curriculum = int(config['curriculum']) == 1
+curriculum_start = 0.3
+if 'curriculum_start' in config:
+    curriculum_start = float(config['curriculum_start'])
+curriculum_epochs = 20
+if 'curriculum_epochs' in config:
+    curriculum_epochs = int(config['curriculum_epochs'])
+
+# bf16 autocast of the dense layers on cpu (sparse products and relKKT stay fp32)
+use_bf16 = False
+if 'bf16' in config:
+    use_bf16 = int(config['bf16']) == 1
+set_dense_bf16(use_bf16)
+
+# sparse product backend (coo / csr / scipy / auto) and thread counts
+spmm_backend = 'csr'
+if 'spmm_backend' in config:
+    spmm_backend = config['spmm_backend']
+set_spmm_backend(spmm_backend,net_width)
+n_threads = 0
+if 'threads' in config:
+    n_threads = int(config['threads'])
+n_interop = 0
+if 'interop_threads' in config:
+    n_interop = int(config['interop_threads'])
+if world_size > 1 and n_threads == 0:
+    # split the cores of a machine between its ranks
+    n_threads = max(1,os.cpu_count()//int(os.environ.get('LOCAL_WORLD_SIZE',world_size)))
+set_threads(n_threads,n_interop)
+
+# memory budget (MB) for the execution planner, defaults to the free device memory
+mem_budget = None
+if 'mem_budget' in config:
+    mem_budget = float(config['mem_budget'])
+
 accum_loss = True
 if int(config['accum_loss'])==0:
     accum_loss = False
+# optimizer step every accum_steps instances
+accum_steps = 1
+if 'accum_steps' in config:
+    accum_steps = int(config['accum_steps'])
 
 if int(config['pareto']) == 0:
     pareto = False
+# full: three backward passes over the weights, rep: gradients w.r.t. the predicted x, y
+elif 'pareto_mode' in config and config['pareto_mode'] == 'rep':
+    pareto = 'rep'
 draw = True
 if int(config['draw']) == 0:
     draw = False
@@ -105,15 +268,18 @@ if max_k > 1:
     use_residual = max_k
 
 if model_mode == 0:
-    m = PDQP_Net_shared(1,1,net_width,max_k = 1, threshold = 1e-8,nlayer=nlayer,type=type_modef).to(device)
+    m = PDQP_Net_shared(1,1,net_width,max_k = deq_iter if use_deq else 1, threshold = 1e-8,nlayer=nlayer,type=type_modef,check_every = ar_check,
+                        deq = use_deq, deq_tol = deq_tol, deq_bwd_iter = deq_bwd_iter).to(device)
+    if use_deq:
+        ident += f'_deq{deq_iter}'
 elif model_mode == 1:
     m = PDQP_Net_AR(1,1,net_width,max_k = 1, threshold = 1e-8,nlayer=nlayer,type=type_modef,use_dual=use_dual).to(device)
     ident += '_AR'
 elif model_mode == 2:
-    m = PDQP_Net_AR_geq(1,1,net_width,max_k = 1, threshold = 1e-8,nlayer=nlayer,tfype=type_modef,use_dual=use_dual,eta_opt=eta_opt,norm=use_norm,div=div, use_residual = use_residual).to(device)
+    m = PDQP_Net_AR_geq(1,1,net_width,max_k = 1, threshold = 1e-8,nlayer=nlayer,tfype=type_modef,use_dual=use_dual,eta_opt=eta_opt,norm=use_norm,div=div, use_residual = use_residual, ckpt_segment = ckpt_segment, check_every = ar_check, truncate = truncate_k, survival = survival).to(device)
     ident += '_ARgeq'
 elif model_mode == 3:
-    m = PDQP_Net_AR_geq(1,1,net_width,max_k = 1, threshold = 1e-8,nlayer=nlayer,tfype=type_modef,use_dual=use_dual,eta_opt=eta_opt,norm=use_norm,div=div,mode=0, use_residual=use_residual).to(device)
+    m = PDQP_Net_AR_geq(1,1,net_width,max_k = 1, threshold = 1e-8,nlayer=nlayer,tfype=type_modef,use_dual=use_dual,eta_opt=eta_opt,norm=use_norm,div=div,mode=0, use_residual=use_residual, ckpt_segment = ckpt_segment, check_every = ar_check, truncate = truncate_k, survival = survival).to(device)
     ident += '_ARgeq'
     if max_k > 1:
         ident += f'_maxk{max_k}'
@@ -122,6 +288,9 @@ elif model_mode == 4:
     m = GNN_AR_geq(1,1,net_width,max_k = 1, threshold = 1e-8,nlayer=nlayer,tfype=type_modef,use_dual=use_dual, eta_opt = eta_opt).to(device)
     ident += '_GNN'
 
+if kkt_sample < 1.0 and isinstance(getattr(m,'qual_func',None),relKKT_general):
+    qf = m.qual_func
+    m.qual_func = relKKT_sampled(type_modef,qf.rgp.eta_opt,qf.rpm.norm,qf.summation,fraction=kkt_sample,full_every=kkt_full_every)
     
 
 # modf=None
@@ -223,21 +392,64 @@ if no_valid:
 
 # train_files = train_files[:3]
 
+if world_size > 1:
+    # every rank trains and validates on its own shard, the sums are reduced per epoch
+    train_files = shard_files(train_files,rank,world_size)
+    valid_files = sorted(valid_files)[rank::world_size]
+
+# forked before the sink / checkpoint threads start and before any training work
+validator = None
+if async_valid and world_size > 1:
+    print('async_valid is not used with several ranks, validating in the training loop')
+elif async_valid:
+    validator = AsyncValidator(m,valid_tar_dir,modf,max_k,valid_threads,f'../logs/metrics_{ident}{"_accLoss" if accum_loss else ""}_valid.{metrics_format}')
+
+sizes = None
+if use_curriculum:
+    sizes = instance_sizes(train_tar_dir,train_files)
+
+sampler = None
+if use_priority:
+    sampler = PrioritySampler(train_files,priority_alpha,priority_beta)
+
 loss_func = torch.nn.MSELoss()
 # optimizer = torch.optim.SGD(m.parameters(), lr=lr1)
 optimizer = torch.optim.AdamW(m.parameters(), lr=lr1)
+if world_size > 1:
+    optimizer = DistOptimizer(optimizer,m)
 max_epoch = args.maxepoch
 best_loss = 1e+20
-flog = open(f'../logs/training/train_log_{ident}.log','w')
+flog = open(f'../logs/training/train_log_{ident}.log' if rank == 0 else os.devnull,'w')
 last_epoch=0
 
 if accum_loss:
     ident+='_accLoss'
 
-loss_log = open(f'../logs/train_{mode}.log','a+')
+loss_log = open(f'../logs/train_{mode}.log' if rank == 0 else os.devnull,'a+')
+metrics = MetricsSink(f'../logs/metrics_{ident}{f"_rank{rank}" if world_size > 1 else ""}.{metrics_format}',metrics_interval)
+
+ckpt_writer = CheckpointWriter()
+ckpt_prefix = f'../model/ckpt_pdqp{ident}_e'
+periodic = list_checkpoints(ckpt_prefix)
+rng_resume = None
 
 loaded = False
-if os.path.exists(f"../model/best_pdqp{ident}.mdl") and Contu:
+if len(periodic) > 0 and Contu:
+    # resume exactly where the last periodic checkpoint left off
+    # self-written, holds the python / numpy rng states and the file order
+    checkpoint = torch.load(periodic[-1],weights_only=False)
+    m.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    last_epoch = checkpoint['nepoch']
+    best_loss = checkpoint['best_loss']
+    if world_size == 1 and sorted(checkpoint['train_files']) == sorted(train_files):
+        train_files = checkpoint['train_files']
+    rng_resume = checkpoint['rng']
+    if sampler is not None and 'sampler' in checkpoint:
+        sampler.load_state_dict(checkpoint['sampler'])
+    print(f'resumed: {periodic[-1]} at epoch {last_epoch}, best val loss {best_loss}')
+    loaded = True
+elif os.path.exists(f"../model/best_pdqp{ident}.mdl") and Contu:
     checkpoint = torch.load(f"../model/best_pdqp{ident}.mdl")
     m.load_state_dict(checkpoint['model'])
     if 'nepoch' in checkpoint:
@@ -246,37 +458,47 @@ if os.path.exists(f"../model/best_pdqp{ident}.mdl") and Contu:
     print(f'loaded: ../model/best_pdqp{ident}.mdl\nLast best val loss gen:  {best_loss}')
     print('Model Loaded'+f"../model/best_pdqp{ident}.mdl")
     loaded=True
+if world_size > 1:
+    broadcast_model(m)
 save_log = True
 f_gg = None
-if args.sl == 0:
+if args.sl == 0 or rank != 0:
     save_log = False
 if save_log:
     valid_files.sort()
     tar = f'{valid_tar_dir}/{valid_files[-1]}'
     f_gg = open(f'../plots/distance/logs/{args.type}_{valid_files[-1]}.rec','a+')
 
-for epoch in range(last_epoch,max_epoch):
-    avg_train_loss = process(m,train_files,epoch,train_tar_dir,pareto=pareto,device=device,optimizer=optimizer,choose_weight=choose_weight,autoregression_iteration=max_k,accu_loss = accum_loss,cur_best=best_loss)
-    avg_train_loss = avg_train_loss[-1] / len(train_files)
+if rng_resume is not None:
+    set_rng_state(rng_resume)
 
-    avg_valid_loss,avg_sc, avg_scprimal, avg_scdual, avg_scgap = process(m,valid_files,epoch,valid_tar_dir,pareto=pareto,device=device,optimizer=modf,choose_weight=choose_weight,autoregression_iteration=max_k,training=False)
-    avg_valid_loss = avg_valid_loss[-1] / len(valid_files)
-    avg_sc = avg_sc[-1]/len(valid_files)
+t_start = time.time()
+last_step_time = None
+final = {}
+time_to_target = None
 
-    for i in range(max_k):
-        avg_scprimal[i] = avg_scprimal[i]/len(valid_files)
-        avg_scdual[i] = avg_scdual[i]/len(valid_files)
-        avg_scgap[i] = avg_scgap[i]/len(valid_files)
+train_hist = {}
 
-
-    st =f'{epoch} {avg_train_loss} {avg_valid_loss}\n'
-    loss_log.write(st)
-    loss_log.flush()
-
-    st = f'epoch{epoch}: train: {avg_train_loss} | valid: {avg_valid_loss}\n'
+for epoch in range(last_epoch,max_epoch):
+    train_stats = {}
+    epoch_files = train_files
+    if use_curriculum:
+        # equal counts on every rank, the shards are padded to the same length
+        epoch_files = curriculum_files(train_files,sizes,epoch,curriculum_start,curriculum_epochs)
+    avg_train_loss = process(m,epoch_files,epoch,train_tar_dir,pareto=pareto,device=device,optimizer=optimizer,choose_weight=choose_weight,autoregression_iteration=max_k,accu_loss = accum_loss,cur_best=best_loss,stats=train_stats,mem_budget=mem_budget,sink=metrics,accum_steps=accum_steps,sampler=sampler,sync_debug=sync_debug)
+    n_train = len(epoch_files)
+    if world_size > 1:
+        avg_train_loss,counts = reduce_lists([avg_train_loss,[n_train]])
+        n_train = counts[0]
+    avg_train_loss = avg_train_loss[-1] / n_train
+    last_step_time = train_stats['step_time']
+
+    st = f'epoch{epoch}: train: {avg_train_loss} | step time: {train_stats["step_time"]} | peak mem(MB): {train_stats["peak_mem"]} | host syncs/step: {train_stats["host_syncs"]} | ckpt: {ckpt_segment} | pareto: {pareto} | accum: {accum_steps} ({train_stats["opt_steps"]} steps) | bf16: {use_bf16} | truncate: {truncate_k} | survival: {survival} | files: {n_train}\n'
     flog.write(st)
     flog.flush()
-    print(f'Epoch{epoch}: train loss:{avg_train_loss}    valid loss:{avg_valid_loss}')
+    metrics.log({'phase':'epoch','epoch':epoch,'loss':avg_train_loss,'step_time':train_stats['step_time'],'peak_mem':train_stats['peak_mem'],'host_syncs':train_stats['host_syncs']})
+    print(f'Epoch{epoch}: train loss:{avg_train_loss}')
+    print(f'    ckpt={ckpt_segment} bf16={use_bf16} nlayer={nlayer} width={net_width}: step time {round(train_stats["step_time"],4)}s   peak mem {round(train_stats["peak_mem"],1)}MB   host syncs/step {round(train_stats["host_syncs"],2)}')
 
     if save_log:
         x,y,sc,pres,dres,gap,x_norm,y_norm = sol_check_model(tar,device,modf,m)
@@ -284,34 +506,101 @@ for epoch in range(last_epoch,max_epoch):
         f_gg.write(st)
         f_gg.flush()
 
-    # if best_loss > avg_valid_loss:
-    #     best_loss = avg_valid_loss
-    #     state={'model':m.state_dict(),'optimizer':optimizer.state_dict(),'best_loss':best_loss,'nepoch':epoch}
-    #     torch.save(state,f'../model/best_pdqp{ident}.mdl')
-    #     print(f'Saving new best model with valid loss: {best_loss}')
-    #     st = f'     Saving new best model with valid loss: {best_loss}\n'
-    #     flog.write(st)
-    #     flog.flush()
-    if loaded:
-        draw_plot(y=avg_scprimal, ident=f'primal_{mode}')
-        draw_plot(y=avg_scdual, ident=f'dual_{mode}')
-        draw_plot(y=avg_scgap, ident=f'gap_{mode}')
-        loaded=False
-    if best_loss > avg_sc:
-        draw_plot(y=avg_scprimal, ident=f'primal_{mode}')
-        draw_plot(y=avg_scdual, ident=f'dual_{mode}')
-        draw_plot(y=avg_scgap, ident=f'gap_{mode}')
-        best_loss = avg_sc
-        state={'model':m.state_dict(),'optimizer':optimizer.state_dict(),'best_loss':avg_sc,'nepoch':epoch}
-        torch.save(state,f'../model/best_pdqp{ident}.mdl')
-        print(f'Saving new best model with valid loss: {avg_sc}')
-        st = f'     Saving new best model with valid loss: {avg_sc}\n'
+    # (epoch, files, sums, snapshot or None for the current model)
+    results = []
+    vfiles = valid_subset(valid_files,valid_subsample,epoch)
+    if (epoch+1) % valid_every == 0 or epoch == max_epoch-1:
+        # kept until the (possibly async) validation of this epoch comes back
+        train_hist[epoch] = avg_train_loss
+        if validator is not None:
+            validator.submit(epoch,{'model':m.state_dict(),'optimizer':optimizer.state_dict()},vfiles)
+        else:
+            res = process(m,vfiles,epoch,valid_tar_dir,pareto=pareto,device=device,optimizer=modf,choose_weight=choose_weight,autoregression_iteration=max_k,training=False,mem_budget=mem_budget,sink=metrics,workers=inst_workers,task_threads=inst_threads)
+            results.append((epoch,len(vfiles),res,None))
+    if validator is not None:
+        results = validator.poll(block = epoch == max_epoch-1)
+
+    for v_epoch,n_valid,res,snapshot in results:
+        avg_valid_loss,avg_sc, avg_scprimal, avg_scdual, avg_scgap = res
+        if world_size > 1:
+            avg_valid_loss,avg_sc,avg_scprimal,avg_scdual,avg_scgap,counts = reduce_lists(
+                [avg_valid_loss,avg_sc,avg_scprimal,avg_scdual,avg_scgap,[n_valid]])
+            n_valid = counts[0]
+        avg_valid_loss = avg_valid_loss[-1] / n_valid
+        avg_sc = avg_sc[-1]/n_valid
+
+        for i in range(max_k):
+            avg_scprimal[i] = avg_scprimal[i]/n_valid
+            avg_scdual[i] = avg_scdual[i]/n_valid
+            avg_scgap[i] = avg_scgap[i]/n_valid
+
+        st =f'{v_epoch} {train_hist.pop(v_epoch)} {avg_valid_loss}\n'
+        loss_log.write(st)
+        loss_log.flush()
+
+        st = f'epoch{v_epoch}: valid: {avg_valid_loss} | relKKT: {avg_sc} ({n_valid} files{", async" if snapshot is not None else ""})\n'
         flog.write(st)
         flog.flush()
-
-
-
-
+        metrics.log({'phase':'epoch','epoch':v_epoch,'valid_loss':avg_valid_loss,'relkkt':avg_sc,'primal':avg_scprimal[-1],'dual':avg_scdual[-1],'gap':avg_scgap[-1]})
+        print(f'Epoch{v_epoch}: valid loss:{avg_valid_loss}    relKKT:{avg_sc}')
+
+        if loaded and rank == 0:
+            draw_plot(y=avg_scprimal, ident=f'primal_{mode}')
+            draw_plot(y=avg_scdual, ident=f'dual_{mode}')
+            draw_plot(y=avg_scgap, ident=f'gap_{mode}')
+            loaded=False
+        # avg_sc is reduced over the ranks, so all of them agree on the best model
+        if best_loss > avg_sc and rank != 0:
+            best_loss = avg_sc
+        elif best_loss > avg_sc:
+            draw_plot(y=avg_scprimal, ident=f'primal_{mode}')
+            draw_plot(y=avg_scdual, ident=f'dual_{mode}')
+            draw_plot(y=avg_scgap, ident=f'gap_{mode}')
+            best_loss = avg_sc
+            if snapshot is None:
+                snapshot = {'model':m.state_dict(),'optimizer':optimizer.state_dict()}
+            state={'model':snapshot['model'],'optimizer':snapshot['optimizer'],'best_loss':avg_sc,'nepoch':v_epoch}
+            ckpt_writer.save(state,f'../model/best_pdqp{ident}.mdl')
+            print(f'Saving new best model with valid loss: {avg_sc}')
+            st = f'     Saving new best model with valid loss: {avg_sc}\n'
+            flog.write(st)
+            flog.flush()
+
+        if target_relkkt is not None and time_to_target is None and avg_sc <= target_relkkt:
+            time_to_target = time.time()-t_start
+            st = f'     relKKT {avg_sc} reached target {target_relkkt} after {round(time_to_target,1)}s\n'
+            flog.write(st)
+            flog.flush()
+            print(st.strip())
+
+        final = {'time_to_target':time_to_target,'epoch':v_epoch,'relkkt':avg_sc,'primal':avg_scprimal[-1],'dual':avg_scdual[-1],'gap':avg_scgap[-1],'valid_loss':avg_valid_loss}
+
+    if ckpt_every > 0 and (epoch+1) % ckpt_every == 0 and rank == 0:
+        # train_files keeps the shuffled order of helper.train, which with the
+        #       rng states reproduces the next epochs after Contu=1
+        state = {'model':m.state_dict(),'optimizer':optimizer.state_dict(),'best_loss':best_loss,'nepoch':epoch+1,
+                 'train_files':list(train_files),'rng':rng_state()}
+        if sampler is not None:
+            state['sampler'] = sampler.state_dict()
+        ckpt_writer.save(state,f'{ckpt_prefix}{epoch}.mdl',ckpt_prefix,ckpt_keep)
+
+
+
+if args.result != '' and rank == 0:
+    final['section'] = args.type
+    final['ident'] = ident
+    final['best_relkkt'] = best_loss
+    final['wall_time'] = time.time()-t_start
+    final['step_time'] = last_step_time
+    with open(args.result,'w') as fres:
+        json.dump(final,fres)
+
+if validator is not None:
+    validator.close()
+ckpt_writer.close()
+metrics.close()
 flog.close()
+if world_size > 1:
+    dist.destroy_process_group()
 if f_gg is not None:
     f_gg.close()
\ No newline at end of file